@@ -0,0 +1,171 @@
+import gzip
+from collections import OrderedDict, namedtuple
+from hashlib import sha1
+from urllib.parse import urlencode
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.renderers import JSONRenderer
+
+# Увеличивается при изменении формата сериализованного рецепта.
+FRAGMENT_FORMAT = 3
+
+
+class LocMemLRUBackend:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    found[key] = self.items[key]
+        return found
+
+    def set_many(self, mapping):
+        with self.lock:
+            self.items.update(mapping)
+            for key in mapping:
+                self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class SharedCacheBackend:
+    def __init__(self, alias, timeout):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set_many(self, mapping):
+        self.cache.set_many(mapping, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def __len__(self):
+        return 0
+
+
+class RecipeFragmentCache:
+    """Кэш пользователь-независимой части сериализованного рецепта.
+
+    Ключ включает версию рецепта, которая увеличивается при любом изменении
+    рецепта, его продуктов, тегов или автора, поэтому устаревшие фрагменты
+    никогда не читаются и просто вытесняются.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(recipe):
+        return (
+            f'recipe:{FRAGMENT_FORMAT}:{recipe.id}:{recipe.version}:'
+            f'{recipe.pub_date.timestamp()}'
+        )
+
+    def get_many(self, recipes):
+        keys = {self.key(recipe): recipe.id for recipe in recipes}
+        found = self.backend.get_many(list(keys))
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return {keys[key]: fragment for key, fragment in found.items()}
+
+    def set_many(self, fragments):
+        self.backend.set_many({
+            self.key(recipe): fragment for recipe, fragment in fragments
+        })
+
+    def invalidate(self, recipe):
+        self.backend.delete(self.key(recipe))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'backend': settings.RECIPE_CACHE_BACKEND,
+            'size': len(self.backend),
+            'max_size': settings.RECIPE_CACHE_SIZE,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0,
+        }
+
+
+def get_backend():
+    if settings.RECIPE_CACHE_BACKEND == 'locmem':
+        return LocMemLRUBackend(settings.RECIPE_CACHE_SIZE)
+    return SharedCacheBackend(
+        settings.RECIPE_CACHE_BACKEND, settings.RECIPE_CACHE_TIMEOUT
+    )
+
+
+recipe_cache = RecipeFragmentCache(get_backend())
+
+
+ReferenceEntry = namedtuple(
+    'ReferenceEntry', ('version', 'etag', 'body', 'compressed')
+)
+
+
+class ReferenceDataCache:
+    """Готовые JSON-ответы справочников в памяти воркера.
+
+    Запись пересобирается, только когда версия справочника в БД
+    отличается от версии, с которой она была построена.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, name, version, build):
+        entry = self.entries.get(name)
+        if entry is None or entry.version != version:
+            body = JSONRenderer().render(build())
+            entry = ReferenceEntry(
+                version,
+                f'"{name}-{sha1(body).hexdigest()}"',
+                body,
+                gzip.compress(body),
+            )
+            self.entries[name] = entry
+        return entry
+
+
+reference_cache = ReferenceDataCache()
+
+
+# Фильтры, результат которых зависит от текущего пользователя.
+USER_FILTERS = ('is_favorited', 'is_in_shopping_cart')
+
+
+def facets_key(query_params, filter_names, user):
+    """Ключ кэша фасетов по параметрам фильтра; для фильтров по избранному
+    и списку покупок в ключ входит пользователь."""
+    params = sorted(
+        (name, value)
+        for name in filter_names
+        for value in query_params.getlist(name)
+        if value
+    )
+    user_id = (
+        user.pk if any(name in USER_FILTERS for name, _ in params) else None
+    )
+    digest = sha1(urlencode(params).encode()).hexdigest()
+    return f'facets:{user_id}:{digest}'
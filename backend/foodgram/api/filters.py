@@ -1,15 +1,44 @@
+from django import forms
+from django.conf import settings
+from django.db.models import (Case, Count, Exists, FloatField, OuterRef, Q,
+                              Subquery, When)
+from django.db.models.functions import Cast, Coalesce, NullIf
 from django_filters.rest_framework import FilterSet, filters
-from rest_framework.filters import SearchFilter
 
-from recipes.models import Ingredient, Recipe, Tag
+from api.indexes import recipe_ingredient_index
+from recipes.models import (POPULARITY, Favorite, IngredientAmount, Recipe,
+                            ShoppingCart, Tag)
+from recipes.search import search_recipes
 
+MATCH_CHOICES = (
+    ('all', 'Все продукты'),
+    ('any', 'Любой из продуктов'),
+    ('most', 'Большая часть продуктов рецепта'),
+)
+ORDERING_CHOICES = (
+    ('popular', 'Популярные'),
+    ('trending', 'Набирающие популярность'),
+)
+ORDERINGS = {
+    'popular': ('-popularity', '-id'),
+    'trending': ('-trending_score', '-id'),
+}
+# Фильтры, по значениям которых считаются фасеты.
+FACET_FILTERS = ('tags', 'cooking_time')
 
-class IngredientFilter(SearchFilter):
-    search_param = 'name'
 
-    class Meta:
-        model = Ingredient
-        fields = ('name',)
+class IdsFilter(filters.BaseInFilter, filters.NumberFilter):
+    field_class = forms.IntegerField
+
+
+def ingredient_count(**lookups):
+    return Coalesce(Subquery(
+        IngredientAmount.objects.filter(
+            recipe=OuterRef('pk'), **lookups
+        ).values('recipe_id').annotate(count=Count('pk')).order_by().values(
+            'count'
+        )
+    ), 0)
 
 
 class RecipeFilter(FilterSet):
@@ -17,22 +46,165 @@ class RecipeFilter(FilterSet):
         field_name='tags__slug',
         to_field_name='slug',
         queryset=Tag.objects.all(),
+        method='filter_tags',
     )
     is_favorited = filters.NumberFilter(method='filter_is_favorited')
     is_in_shopping_cart = filters.NumberFilter(
         method='filter_is_in_shopping_cart'
     )
+    cooking_time = filters.ChoiceFilter(
+        choices=[
+            (name, label) for name, _, _, label in Recipe.COOKING_TIME_BUCKETS
+        ],
+        method='filter_cooking_time'
+    )
+    search = filters.CharFilter(method='filter_search')
+    ingredients = IdsFilter(method='filter_ingredients')
+    exclude_ingredients = IdsFilter(method='filter_exclude_ingredients')
+    match = filters.ChoiceFilter(choices=MATCH_CHOICES, method='filter_match')
+    # Объявлен последним, чтобы сортировка применялась после остальных
+    # фильтров.
+    ordering = filters.ChoiceFilter(
+        choices=ORDERING_CHOICES, method='filter_ordering'
+    )
 
     class Meta:
         model = Recipe
-        fields = ('tags', 'author', 'is_favorited', 'is_in_shopping_cart',)
+        fields = (
+            'tags', 'author', 'is_favorited', 'is_in_shopping_cart',
+            'cooking_time', 'search', 'ingredients', 'exclude_ingredients',
+            'match', 'ordering',
+        )
 
-    def filter_is_favorited(self, recipes, name, value):
+    @staticmethod
+    def has_tag(tags):
+        return Q(Exists(Recipe.tags.through.objects.filter(
+            recipe_id=OuterRef('pk'), tag__in=tags
+        )))
+
+    def facets(self):
+        """Число рецептов для каждого тега и интервала времени
+        приготовления при остальных условиях фильтра.
+
+        Все счетчики считаются одним агрегирующим запросом. Значения
+        фасета не сужают его собственные счетчики, но учитываются
+        в счетчиках другого фасета.
+        """
+        recipes = self.queryset.all()
+        for name, value in self.form.cleaned_data.items():
+            if name not in FACET_FILTERS:
+                recipes = self.filters[name].filter(recipes, value)
+        selected_tags = self.form.cleaned_data.get('tags')
+        bucket = self.form.cleaned_data.get('cooking_time')
+        tags_q = self.has_tag(selected_tags) if selected_tags else Q()
+        time_q = Recipe.cooking_time_q(bucket) if bucket else Q()
+        tags = list(Tag.objects.all())
+        counts = recipes.aggregate(
+            count=Count('pk', filter=tags_q & time_q),
+            **{
+                f'tag_{tag.id}': Count(
+                    'pk', filter=self.has_tag([tag.id]) & time_q
+                )
+                for tag in tags
+            },
+            **{
+                f'time_{name}': Count(
+                    'pk', filter=Recipe.cooking_time_q(name) & tags_q
+                )
+                for name, *_ in Recipe.COOKING_TIME_BUCKETS
+            },
+        )
+        return {
+            'count': counts['count'],
+            'tags': [
+                {
+                    'id': tag.id,
+                    'name': tag.name,
+                    'slug': tag.slug,
+                    'count': counts[f'tag_{tag.id}'],
+                }
+                for tag in tags
+            ],
+            'cooking_time': [
+                {'value': name, 'name': label, 'count': counts[f'time_{name}']}
+                for name, _, _, label in Recipe.COOKING_TIME_BUCKETS
+            ],
+        }
+
+    def filter_tags(self, recipes, name, value):
+        if not value:
+            return recipes
+        return recipes.filter(self.has_tag(value))
+
+    def filter_cooking_time(self, recipes, name, value):
+        return recipes.filter(Recipe.cooking_time_q(value))
+
+    def filter_user_recipes(self, recipes, model, value):
         if value and self.request.user.is_authenticated:
-            return recipes.filter(favorites__user=self.request.user)
+            return recipes.filter(Exists(model.objects.filter(
+                user=self.request.user, recipe_id=OuterRef('pk')
+            )))
         return recipes
 
+    def filter_is_favorited(self, recipes, name, value):
+        return self.filter_user_recipes(recipes, Favorite, value)
+
     def filter_is_in_shopping_cart(self, recipes, name, value):
-        if value and self.request.user.is_authenticated:
-            return recipes.filter(shoppingcarts__user=self.request.user)
-        return
+        return self.filter_user_recipes(recipes, ShoppingCart, value)
+
+    def filter_search(self, recipes, name, value):
+        return search_recipes(recipes, value)
+
+    def filter_match(self, recipes, name, value):
+        # Режим учитывается в filter_ingredients.
+        return recipes
+
+    def filter_ingredients(self, recipes, name, value):
+        mode = self.form.cleaned_data.get('match') or 'all'
+        if mode == 'any':
+            return recipes.filter(Exists(IngredientAmount.objects.filter(
+                recipe=OuterRef('pk'), ingredient__in=value
+            )))
+        if settings.RECIPE_INGREDIENT_INDEX:
+            ids = recipe_ingredient_index.match(
+                value, mode, settings.RECIPE_MATCH_LIMIT
+            )
+            if ids is not None:
+                recipes = recipes.filter(pk__in=ids)
+                if mode == 'most':
+                    recipes = recipes.order_by(Case(
+                        *(When(pk=pk, then=position)
+                          for position, pk in enumerate(ids))
+                    ))
+                return recipes
+        return self.match_in_db(recipes, value, mode)
+
+    @staticmethod
+    def match_in_db(recipes, ingredient_ids, mode):
+        if mode == 'all':
+            for ingredient_id in set(ingredient_ids):
+                recipes = recipes.filter(Exists(
+                    IngredientAmount.objects.filter(
+                        recipe=OuterRef('pk'), ingredient_id=ingredient_id
+                    )
+                ))
+            return recipes
+        return recipes.annotate(
+            ingredient_coverage=(
+                Cast(ingredient_count(ingredient__in=ingredient_ids),
+                     FloatField())
+                / Cast(NullIf(ingredient_count(), 0), FloatField())
+            )
+        ).filter(
+            ingredient_coverage__gte=settings.RECIPE_MATCH_MOST_COVERAGE
+        ).order_by('-ingredient_coverage', '-pub_date', '-id')
+
+    def filter_ordering(self, recipes, name, value):
+        if value == 'popular':
+            recipes = recipes.annotate(popularity=POPULARITY)
+        return recipes.order_by(*ORDERINGS[value])
+
+    def filter_exclude_ingredients(self, recipes, name, value):
+        return recipes.exclude(Exists(IngredientAmount.objects.filter(
+            recipe=OuterRef('pk'), ingredient__in=value
+        )))
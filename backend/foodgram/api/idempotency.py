@@ -0,0 +1,48 @@
+from functools import wraps
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.response import Response
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def idempotent(view):
+    """Повторный запрос с тем же заголовком Idempotency-Key получает
+    сохраненный ответ первого запроса без обращения к базе."""
+    @wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key or request.user.is_anonymous:
+            return view(self, request, *args, **kwargs)
+        cache = caches[settings.IDEMPOTENCY_CACHE]
+        cache_key = 'idempotency:{}:{}'.format(
+            request.user.pk,
+            sha1(f'{request.method}:{request.path}:{key}'.encode()).hexdigest()
+        )
+        stored = cache.get(cache_key)
+        if stored is not None:
+            status_code, data = stored
+            response = Response(data, status=status_code)
+            response['Idempotent-Replayed'] = 'true'
+            return response
+        lock_key = f'{cache_key}:lock'
+        if not cache.add(lock_key, True, settings.IDEMPOTENCY_LOCK_TIMEOUT):
+            return Response(
+                {'detail': 'Запрос с этим ключом уже выполняется'},
+                status=status.HTTP_409_CONFLICT
+            )
+        try:
+            response = view(self, request, *args, **kwargs)
+            if response.status_code < 500:
+                cache.set(
+                    cache_key,
+                    (response.status_code, response.data),
+                    settings.IDEMPOTENCY_TIMEOUT
+                )
+            return response
+        finally:
+            cache.delete(lock_key)
+    return wrapper
@@ -0,0 +1,323 @@
+import re
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, namedtuple
+from datetime import timedelta
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+import numpy as np
+from django.conf import settings
+from django.contrib.postgres.search import (TrigramSimilarity,
+                                            TrigramWordSimilarity)
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from recipes.models import DataVersion, Ingredient, IngredientAmount
+
+WORD_SPLITTER = re.compile(r'[\W_]+')
+
+Snapshot = namedtuple(
+    'Snapshot',
+    (
+        'rows', 'keys', 'word_keys', 'word_rows', 'postings', 'sizes',
+        'positions'
+    )
+)
+
+
+def normalize(text):
+    return ' '.join(text.casefold().replace('ё', 'е').split())
+
+
+def trigrams(text):
+    """Триграммы в духе pg_trgm: каждое слово дополняется двумя пробелами
+    в начале и одним в конце."""
+    return {
+        padded[index:index + 3]
+        for word in WORD_SPLITTER.split(text) if word
+        for padded in (f'  {word} ',)
+        for index in range(len(padded) - 2)
+    }
+
+
+def prefixed(keys, prefix):
+    for position in range(bisect_left(keys, prefix), len(keys)):
+        if not keys[position].startswith(prefix):
+            break
+        yield position
+
+
+class IngredientIndex:
+    """Отсортированные массивы названий продуктов для поиска по префиксу
+    и триграммный инвертированный индекс для нечёткого поиска.
+
+    Строится лениво при первом обращении и перестраивается, когда версия
+    справочника продуктов в БД меняется. Версия проверяется не чаще раза
+    в INGREDIENT_VERSION_CHECK_INTERVAL секунд, поэтому поиск обычно
+    обходится без запросов к БД. Нечёткий поиск (на PostgreSQL - через
+    pg_trgm) выполняется, только если по префиксу ничего не найдено.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.checked_at = None
+        self.snapshot = None
+
+    def build(self, version):
+        rows = sorted(
+            Ingredient.objects.values_list('id', 'name', 'measurement_unit'),
+            key=lambda row: (normalize(row[1]), row[2])
+        )
+        keys = [normalize(name) for _, name, _ in rows]
+        words = sorted(
+            (word, position)
+            for position, key in enumerate(keys)
+            for word in WORD_SPLITTER.split(key)[1:]
+            if word
+        )
+        postings = defaultdict(lambda: array('I'))
+        sizes = array('H')
+        for position, key in enumerate(keys):
+            grams = trigrams(key)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings[gram].append(position)
+        self.snapshot = Snapshot(
+            rows,
+            keys,
+            [word for word, _ in words],
+            [position for _, position in words],
+            dict(postings),
+            sizes,
+            {row[0]: position for position, row in enumerate(rows)},
+        )
+        self.version = version
+
+    def get_snapshot(self):
+        now = monotonic()
+        interval = settings.INGREDIENT_VERSION_CHECK_INTERVAL
+        if self.checked_at is None or now - self.checked_at >= interval:
+            version = DataVersion.get(DataVersion.INGREDIENTS)
+            if self.version != version:
+                with self.lock:
+                    if self.version != version:
+                        self.build(version)
+            self.checked_at = now
+        return self.snapshot
+
+    def expire(self):
+        self.checked_at = None
+
+    @staticmethod
+    def find(snapshot, query):
+        prefix = normalize(query)
+        yield from prefixed(snapshot.keys, prefix)
+        for position in prefixed(snapshot.word_keys, prefix):
+            yield snapshot.word_rows[position]
+
+    @staticmethod
+    def find_similar(snapshot, query):
+        """Нечёткий поиск по доле триграмм запроса, найденных в названии
+        (аналог word_similarity из pg_trgm).
+
+        Название, набравшее порог, обязано встретиться хотя бы в одном из
+        самых коротких списков, поэтому оцениваются только они.
+        """
+        query_grams = trigrams(normalize(query))
+        if not query_grams:
+            return []
+        threshold = settings.INGREDIENT_SIMILARITY_THRESHOLD
+        required = max(1, ceil(threshold * len(query_grams)))
+        postings = sorted(
+            (snapshot.postings.get(gram, ()) for gram in query_grams), key=len
+        )
+        shared = Counter()
+        for posting in postings:
+            shared.update(posting)
+        scored = []
+        for position in set().union(
+            *postings[:len(query_grams) - required + 1]
+        ):
+            count = shared[position]
+            if count < required:
+                continue
+            scored.append((
+                -count / len(query_grams),
+                -count / (
+                    len(query_grams) + snapshot.sizes[position] - count
+                ),
+                position
+            ))
+        return [position for *_, position in sorted(scored)]
+
+    @staticmethod
+    def find_similar_in_db(snapshot, query):
+        ids = Ingredient.objects.filter(
+            name__trigram_word_similar=query
+        ).annotate(
+            word_similarity=TrigramWordSimilarity(query, 'name'),
+            similarity=TrigramSimilarity('name', query),
+        ).order_by(
+            '-word_similarity', '-similarity'
+        ).values_list('id', flat=True)
+        return [
+            snapshot.positions[pk]
+            for pk in ids[:settings.INGREDIENT_SEARCH_LIMIT]
+            if pk in snapshot.positions
+        ]
+
+    @staticmethod
+    def serialize(snapshot, positions):
+        return [
+            {
+                'id': snapshot.rows[position][0],
+                'name': snapshot.rows[position][1],
+                'measurement_unit': snapshot.rows[position][2],
+            } for position in positions
+        ]
+
+    def search(self, query, limit=None):
+        snapshot = self.get_snapshot()
+        limit = limit or settings.INGREDIENT_SEARCH_LIMIT
+        found = {}
+        for position in self.find(snapshot, query):
+            found.setdefault(position)
+            if len(found) >= limit:
+                break
+        if not found:
+            # Нечёткий поиск нужен для опечаток, а запрос с опечаткой не
+            # совпадает по префиксу ни с одним названием.
+            find_similar = (
+                self.find_similar_in_db if connection.vendor == 'postgresql'
+                else self.find_similar
+            )
+            found = dict.fromkeys(find_similar(snapshot, query)[:limit])
+        return self.serialize(snapshot, found)
+
+    def all(self):
+        snapshot = self.get_snapshot()
+        return self.serialize(snapshot, range(len(snapshot.rows)))
+
+
+ingredient_index = IngredientIndex()
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredients_changed(sender, **kwargs):
+    # Изменения в этом процессе видны сразу, в остальных - после
+    # очередной проверки версии.
+    ingredient_index.expire()
+    transaction.on_commit(ingredient_index.expire)
+
+
+class RecipeIngredientIndex:
+    """Обратный индекс продукт -> id рецептов для подбора рецептов
+    по имеющимся продуктам.
+
+    Списки id хранятся в array('I'), а не в битовых множествах: продукт
+    встречается в малой доле рецептов, и битовое множество на миллион
+    рецептов для каждого продукта заняло бы больше памяти. Пересечение и
+    подсчет совпадений выполняет numpy поверх тех же буферов без
+    копирования. При каждом обращении индекс дочитывает рецепты,
+    измененные с прошлой синхронизации; удаленные рецепты отсекает
+    последующий запрос к БД.
+    """
+    EMPTY = array('I')
+    # Запас на транзакции, зафиксированные позже своего updated_at.
+    SYNC_OVERLAP = timedelta(seconds=5)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.postings = {}
+        self.recipes = {}
+        self.sizes = array('H')
+        self.synced_at = None
+
+    def build(self, rows):
+        postings = defaultdict(lambda: array('I'))
+        recipes = defaultdict(list)
+        for recipe_id, ingredient_id in rows.iterator(chunk_size=10000):
+            postings[ingredient_id].append(recipe_id)
+            recipes[recipe_id].append(ingredient_id)
+        self.postings = dict(postings)
+        self.recipes = {
+            recipe_id: tuple(ingredient_ids)
+            for recipe_id, ingredient_ids in recipes.items()
+        }
+        self.sizes = array('H', bytes(2 * (max(recipes, default=0) + 1)))
+        for recipe_id, ingredient_ids in recipes.items():
+            self.sizes[recipe_id] = len(ingredient_ids)
+
+    def replace(self, recipe_id, ingredient_ids):
+        old_ids = set(self.recipes.get(recipe_id, ()))
+        for ingredient_id in old_ids - ingredient_ids:
+            self.postings[ingredient_id].remove(recipe_id)
+        for ingredient_id in ingredient_ids - old_ids:
+            self.postings.setdefault(ingredient_id, array('I')).append(
+                recipe_id
+            )
+        self.recipes[recipe_id] = tuple(ingredient_ids)
+        if recipe_id >= len(self.sizes):
+            self.sizes.extend(array('H', bytes(
+                2 * (recipe_id + 1 - len(self.sizes))
+            )))
+        self.sizes[recipe_id] = len(ingredient_ids)
+
+    def sync(self):
+        started_at = timezone.now()
+        rows = IngredientAmount.objects.order_by().distinct().values_list(
+            'recipe_id', 'ingredient_id'
+        )
+        if self.synced_at is None:
+            self.build(rows)
+        else:
+            changed = defaultdict(set)
+            for recipe_id, ingredient_id in rows.filter(
+                recipe__updated_at__gte=self.synced_at - self.SYNC_OVERLAP
+            ):
+                changed[recipe_id].add(ingredient_id)
+            for recipe_id, ingredient_ids in changed.items():
+                self.replace(recipe_id, ingredient_ids)
+        self.synced_at = started_at
+
+    def match(self, ingredient_ids, mode, limit):
+        """id рецептов, содержащих все переданные продукты (mode='all'),
+        или не более limit рецептов, состоящих из переданных продуктов
+        хотя бы на RECIPE_MATCH_MOST_COVERAGE, по убыванию этой доли
+        (mode='most'). Для 'all' возвращает None, если совпадений больше
+        limit."""
+        with self.lock:
+            self.sync()
+            postings = sorted(
+                (np.frombuffer(
+                    self.postings.get(ingredient_id, self.EMPTY),
+                    dtype=np.uint32
+                ) for ingredient_id in set(ingredient_ids)),
+                key=len
+            )
+            if mode == 'all':
+                found = postings[0]
+                for recipe_ids in postings[1:]:
+                    found = np.intersect1d(
+                        found, recipe_ids, assume_unique=True
+                    )
+                return found.tolist() if len(found) <= limit else None
+            matched = np.bincount(
+                np.concatenate(postings), minlength=len(self.sizes)
+            )
+            sizes = np.frombuffer(self.sizes, dtype=np.uint16)
+            candidates = np.flatnonzero(
+                (matched > 0)
+                & (matched >= sizes * settings.RECIPE_MATCH_MOST_COVERAGE)
+            )
+            coverage = matched[candidates] / sizes[candidates]
+            order = np.lexsort((-candidates, -coverage))[:limit]
+            return candidates[order].tolist()
+
+
+recipe_ingredient_index = RecipeIngredientIndex()
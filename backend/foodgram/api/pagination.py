@@ -1,6 +1,34 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+PAGE_SIZE = 6
+MAX_PAGE_SIZE = 100
+
+
+class KeysetPagination(CursorPagination):
+    page_size_query_param = 'limit'
+    page_size = PAGE_SIZE
+    max_page_size = MAX_PAGE_SIZE
+    ordering = ('-pub_date', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        return getattr(view, 'cursor_ordering', self.ordering)
 
 
 class Pagination(PageNumberPagination):
     page_size_query_param = 'limit'
-    page_size = 6
+    page_size = PAGE_SIZE
+    max_page_size = MAX_PAGE_SIZE
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if KeysetPagination.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+        self.keyset = KeysetPagination()
+        if hasattr(view, 'get_cursor_ordering'):
+            self.keyset.ordering = view.get_cursor_ordering()
+        return self.keyset.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is None:
+            return super().get_paginated_response(data)
+        return self.keyset.get_paginated_response(data)
@@ -1,14 +1,35 @@
-from django.shortcuts import get_object_or_404
+import json
+from collections import Counter
+
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import QueryDict
 from djoser.serializers import UserSerializer as DjosersUserSerializer
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers, status
+from rest_framework.settings import api_settings
 
+from api.cache import recipe_cache
 from recipes.models import (
     Favorite, Follow, Ingredient, IngredientAmount,
-    Recipe, ShoppingCart, Tag, User
+    Recipe, ShoppingCart, ShoppingListItem, Tag, User
 )
 
 
+def create_unique(model, message, **fields):
+    """Создает запись одним INSERT, нарушение ограничения уникальности
+    превращается в ошибку валидации с текстом message."""
+    try:
+        with transaction.atomic():
+            User.lock(fields['user'].pk)
+            return model.objects.create(**fields)
+    except IntegrityError:
+        raise serializers.ValidationError(
+            {api_settings.NON_FIELD_ERRORS_KEY: [message]}
+        )
+
+
 class UserSerializer(DjosersUserSerializer):
     is_subscribed = serializers.SerializerMethodField(read_only=True)
 
@@ -24,6 +45,8 @@ class UserSerializer(DjosersUserSerializer):
         )
 
     def get_is_subscribed(self, user):
+        if hasattr(user, 'is_subscribed'):
+            return user.is_subscribed
         request = self.context.get('request')
         if request.user.is_anonymous:
             return False
@@ -31,7 +54,7 @@ class UserSerializer(DjosersUserSerializer):
 
 
 class SubscribesSerializer(UserSerializer):
-    recipes_count = serializers.ReadOnlyField(source='recipes.count')
+    recipes_count = serializers.IntegerField(read_only=True)
     recipes = serializers.SerializerMethodField()
 
     class Meta(UserSerializer.Meta):
@@ -43,36 +66,66 @@ class SubscribesSerializer(UserSerializer):
         read_only_fields = ('email', 'username', 'first_name', 'last_name')
 
     def validate(self, data):
-        author_id = self.context.get(
-            'request').parser_context.get('kwargs').get('id')
-        author = get_object_or_404(User, id=author_id)
-        user = self.context.get('request').user
-        if Follow.objects.filter(user=user, author=author_id):
-            raise serializers.ValidationError(
-                detail='Подписка уже существует',
-                code=status.HTTP_400_BAD_REQUEST,
-            )
-        if user == author:
+        if self.context.get('request').user == self.instance:
             raise serializers.ValidationError(
                 detail='Нельзя подписаться на самого себя',
                 code=status.HTTP_400_BAD_REQUEST,
             )
         return data
 
-    def get_recipes(self, subscribe):
-        request = self.context.get('request')
-        limit = int(request.GET.get('recipes_limit', 10 ** 10))
+    def create_follow(self):
+        return create_unique(
+            Follow, 'Подписка уже существует',
+            user=self.context.get('request').user, author=self.instance
+        )
+
+    def get_recipes(self, author):
         return RecipeShortSerializer(
-            subscribe.recipes.all()[: limit],
+            author.limited_recipes,
             many=True,
             read_only=True
         ).data
 
 
+class RecipeImageField(Base64ImageField):
+    """Изображение файлом из multipart-запроса или строкой base64."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, UploadedFile):
+            return serializers.ImageField.to_internal_value(self, data)
+        return super().to_internal_value(data)
+
+
+def absolute_uri(request, url):
+    return request.build_absolute_uri(url) if request and url else url
+
+
+def variant_urls(recipe):
+    return {
+        variant: recipe.image.storage.url(name)
+        for variant, name in recipe.get_image_variants().items()
+    }
+
+
+class ImageVariantsField(serializers.Field):
+    """Ссылки на уменьшенные копии изображения рецепта."""
+
+    def __init__(self, **kwargs):
+        super().__init__(source='*', read_only=True, **kwargs)
+
+    def to_representation(self, recipe):
+        return {
+            variant: absolute_uri(self.context.get('request'), url)
+            for variant, url in variant_urls(recipe).items()
+        }
+
+
 class RecipeShortSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
 
 
 class TagSerializer(serializers.ModelSerializer):
@@ -114,6 +167,26 @@ class IngredientAmountSerializer(serializers.ModelSerializer):
         return representation
 
 
+class RecipeListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        recipes = list(data.all() if hasattr(data, 'all') else data)
+        fragments = recipe_cache.get_many(recipes)
+        missed = [recipe for recipe in recipes if recipe.id not in fragments]
+        if missed:
+            self.child.prefetch(missed)
+            built = [
+                (recipe, self.child.to_fragment(recipe)) for recipe in missed
+            ]
+            recipe_cache.set_many(built)
+            fragments.update(
+                (recipe.id, fragment) for recipe, fragment in built
+            )
+        return [
+            self.child.overlay(recipe, fragments[recipe.id])
+            for recipe in recipes
+        ]
+
+
 class ReadRecipeSerializer(serializers.ModelSerializer):
     tags = TagSerializer(read_only=False, many=True)
     ingredients = IngredientAmountSerializer(
@@ -123,6 +196,7 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
     author = UserSerializer(many=False, read_only=True)
     is_in_shopping_cart = serializers.SerializerMethodField()
     is_favorited = serializers.SerializerMethodField()
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipe
@@ -135,21 +209,76 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_variants',
             'text',
             'cooking_time'
         )
+        list_serializer_class = RecipeListSerializer
+
+    @staticmethod
+    def prefetch(recipes):
+        prefetch_related_objects(
+            recipes,
+            'tags',
+            Prefetch(
+                'ingredientinrecipes',
+                queryset=IngredientAmount.objects.select_related('ingredient')
+            ),
+        )
+
+    def to_fragment(self, recipe):
+        fragment = super().to_representation(recipe)
+        fragment['is_favorited'] = None
+        fragment['is_in_shopping_cart'] = None
+        fragment['author']['is_subscribed'] = None
+        # Фрагмент общий для всех запросов, поэтому ссылки в нем
+        # относительные: хост и схему подставляет overlay().
+        fragment['image'] = recipe.image.url if recipe.image else None
+        fragment['image_variants'] = variant_urls(recipe)
+        return fragment
+
+    def overlay(self, recipe, fragment):
+        request = self.context.get('request')
+        return {
+            **fragment,
+            'image': absolute_uri(request, fragment['image']),
+            'image_variants': {
+                variant: absolute_uri(request, url)
+                for variant, url in fragment['image_variants'].items()
+            },
+            'author': {
+                **fragment['author'],
+                'is_subscribed': self.fields['author'].get_is_subscribed(
+                    recipe.author
+                ),
+            },
+            'is_favorited': self.get_is_favorited(recipe),
+            'is_in_shopping_cart': self.get_is_in_shopping_cart(recipe),
+        }
 
-    def get_flagged(self, recipe, model):
+    def to_representation(self, recipe):
+        fragment = recipe_cache.get_many([recipe]).get(recipe.id)
+        if fragment is None:
+            self.prefetch([recipe])
+            fragment = self.to_fragment(recipe)
+            recipe_cache.set_many([(recipe, fragment)])
+        return self.overlay(recipe, fragment)
+
+    def get_flagged(self, recipe, model, annotation):
+        if hasattr(recipe, annotation):
+            return getattr(recipe, annotation)
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
         return model.objects.filter(user=request.user, recipe=recipe).exists()
 
     def get_is_favorited(self, recipe):
-        return self.get_flagged(recipe, Favorite)
+        return self.get_flagged(recipe, Favorite, 'is_favorited')
 
     def get_is_in_shopping_cart(self, recipe):
-        return self.get_flagged(recipe, ShoppingCart)
+        return self.get_flagged(
+            recipe, ShoppingCart, 'is_in_shopping_cart'
+        )
 
     def get_ingredients(self, recipe):
         return IngredientAmountSerializer(
@@ -158,14 +287,11 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
 
 
 class CreateRecipeSerializer(serializers.ModelSerializer):
-    tags = serializers.PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(),
-        many=True
-    )
+    tags = serializers.ListField(child=serializers.IntegerField())
     author = UserSerializer(read_only=True)
     ingredients = IngredientsCreateSerializer(many=True)
     cooking_time = serializers.IntegerField()
-    image = Base64ImageField()
+    image = RecipeImageField()
 
     class Meta:
         model = Recipe
@@ -180,49 +306,74 @@ class CreateRecipeSerializer(serializers.ModelSerializer):
             'cooking_time'
         )
 
+    def to_internal_value(self, data):
+        if isinstance(data, QueryDict):
+            # В multipart-запросе теги передаются списком полей,
+            # а продукты - строкой JSON.
+            multipart = data
+            data = multipart.dict()
+            if 'tags' in multipart:
+                data['tags'] = multipart.getlist('tags')
+            if 'ingredients' in multipart:
+                try:
+                    data['ingredients'] = json.loads(multipart['ingredients'])
+                except ValueError:
+                    raise serializers.ValidationError(
+                        {'ingredients': ['Ожидается список в формате JSON']}
+                    )
+        return super().to_internal_value(data)
+
     @staticmethod
-    def validate_repeat_existence(items, model):
+    def find_errors(items, model):
+        verbose_name = model._meta.verbose_name
+        found = set(
+            model.objects.filter(id__in=items).values_list('id', flat=True)
+        )
+        errors = []
         invalid_items = [
-            item_id for item_id in items
-            if not model.objects.filter(id=item_id).exists()
+            item_id for item_id in dict.fromkeys(items)
+            if item_id not in found
         ]
         if invalid_items:
-            raise serializers.ValidationError(
+            errors.append(
                 f'Несуществующие элементы для модели '
-                f'{model._meta.verbose_name}: {invalid_items}'
+                f'{verbose_name}: {invalid_items}'
             )
-        duplicate_items = {
-            item_id for item_id in items if items.count(item_id) > 1
-        }
+        duplicate_items = [
+            item_id for item_id, count in Counter(items).items() if count > 1
+        ]
         if duplicate_items:
-            raise serializers.ValidationError(
+            errors.append(
                 f'Повторяющиеся элементы для модели '
-                f'{model._meta.verbose_name}: {duplicate_items}'
+                f'{verbose_name}: {duplicate_items}'
             )
+        return errors
 
     def validate(self, data):
-        tags = data.get('tags')
-        ingredients = data.get('ingredients')
-
-        self.validate_repeat_existence([tag.id for tag in tags], Tag)
-        self.validate_repeat_existence(
-            [item['id'] for item in ingredients], Ingredient
-        )
+        tags = data.get('tags', [])
+        ingredients = data.get('ingredients', [])
 
+        errors = [
+            *self.find_errors(tags, Tag),
+            *self.find_errors([item['id'] for item in ingredients],
+                              Ingredient),
+        ]
         incorrect_ingredients = [
             item['id'] for item in ingredients if item['amount'] < 1
         ]
         if incorrect_ingredients:
-            raise serializers.ValidationError(
+            errors.append(
                 f'Количество у продуктов: {incorrect_ingredients} '
                 f'должно быть не менее 1'
             )
         cooking_time = data.get('cooking_time')
-        if cooking_time < 1:
-            raise serializers.ValidationError(
+        if cooking_time is not None and cooking_time < 1:
+            errors.append(
                 f'Время должно быть больше одной минуты. '
                 f'Текущее значение: {cooking_time}.'
             )
+        if errors:
+            raise serializers.ValidationError(errors)
         return data
 
     @staticmethod
@@ -235,6 +386,7 @@ class CreateRecipeSerializer(serializers.ModelSerializer):
             ) for ingredient in ingredients
         )
 
+    @transaction.atomic
     def create(self, validated_data):
         request = self.context.get('request', None)
         ingredients = validated_data.pop('ingredients')
@@ -244,11 +396,54 @@ class CreateRecipeSerializer(serializers.ModelSerializer):
         self.ingredients_create(ingredients, recipe)
         return recipe
 
+    @staticmethod
+    def ingredients_update(ingredients, recipe):
+        """Применяет к рецепту только разницу между сохраненными и
+        переданными продуктами."""
+        submitted = {item['id']: item['amount'] for item in ingredients}
+        existing = {}
+        removed = []
+        for row in recipe.ingredientinrecipes.all():
+            if (
+                row.ingredient_id in existing
+                or row.ingredient_id not in submitted
+            ):
+                removed.append(row.pk)
+            else:
+                existing[row.ingredient_id] = row
+        old_amounts = recipe.ingredient_amounts() if removed else {
+            ingredient_id: row.amount
+            for ingredient_id, row in existing.items()
+        }
+        changed = []
+        for ingredient_id, row in existing.items():
+            if row.amount != submitted[ingredient_id]:
+                row.amount = submitted[ingredient_id]
+                changed.append(row)
+        created = [
+            IngredientAmount(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount
+            )
+            for ingredient_id, amount in submitted.items()
+            if ingredient_id not in existing
+        ]
+        if not (removed or changed or created):
+            return
+        IngredientAmount.objects.bulk_update(changed, ('amount',))
+        IngredientAmount.objects.bulk_create(created)
+        if removed:
+            IngredientAmount.objects.filter(pk__in=removed).delete()
+        ShoppingListItem.recipe_changed(recipe, old_amounts)
+
+    @transaction.atomic
     def update(self, instance, validated_data):
-        ingredients = validated_data.pop('ingredients')
-        instance.ingredients.clear()
-        self.ingredients_create(ingredients, instance)
-        instance.tags.set(validated_data.pop('tags'))
+        recipe_cache.invalidate(instance)
+        if 'ingredients' in validated_data:
+            self.ingredients_update(
+                validated_data.pop('ingredients'), instance
+            )
+        if 'tags' in validated_data:
+            instance.tags.set(validated_data.pop('tags'))
         return super().update(instance, validated_data)
 
     def to_representation(self, instance):
@@ -259,24 +454,34 @@ class CreateRecipeSerializer(serializers.ModelSerializer):
 
 
 class ShortRecipeSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
+
+
+class BulkIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=100,
+    )
 
 
 class BaseUserRecipeSerializer(serializers.ModelSerializer):
     class Meta:
         abstract = True
         fields = ('user', 'recipe')
+        read_only_fields = fields
 
-    def validate(self, data):
+    def create(self, validated_data):
         model = self.Meta.model
-        if model.objects.filter(
-            user=data['user'], recipe=data['recipe']
-        ).exists():
-            raise serializers.ValidationError(
-                f'Рецепт уже добавлен в {model._meta.verbose_name}')
-        return data
+        return create_unique(
+            model,
+            f'Рецепт уже добавлен в {model._meta.verbose_name}',
+            **validated_data
+        )
 
     def to_representation(self, instance):
         return ShortRecipeSerializer(
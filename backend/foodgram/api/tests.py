@@ -0,0 +1,578 @@
+import csv
+import re
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from api import cache
+from recipes.models import (Favorite, FeedEntry, Follow, Ingredient,
+                            IngredientAmount, Recipe, ShoppingCart, Tag, User)
+
+
+def create_user(username):
+    return User.objects.create(
+        username=username,
+        email=f'{username}@example.com',
+        first_name=username,
+        last_name=username,
+    )
+
+
+def create_recipes(author, count, tags=(), ingredients=()):
+    """Рецепты без сигналов и файлов изображений: достаточно имени файла."""
+    recipes = Recipe.objects.bulk_create(
+        Recipe(
+            author=author,
+            name=f'{author.username} {number}',
+            text='Описание',
+            cooking_time=10,
+            image=f'recipes/image/{author.username}-{number}.png',
+        )
+        for number in range(count)
+    )
+    Recipe.tags.through.objects.bulk_create(
+        Recipe.tags.through(recipe_id=recipe.id, tag_id=tag.id)
+        for recipe in recipes for tag in tags
+    )
+    IngredientAmount.objects.bulk_create(
+        IngredientAmount(recipe=recipe, ingredient=ingredient, amount=100)
+        for recipe in recipes for ingredient in ingredients
+    )
+    return recipes
+
+
+class RecipeListQueriesTest(TestCase):
+    """Число запросов списка рецептов не зависит от размера страницы."""
+
+    # Количество, страница с флагами пользователя, авторы с подпиской;
+    # при пустом кэше фрагментов еще теги и продукты.
+    WARM_QUERIES = 3
+    COLD_QUERIES = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        author = create_user('author')
+        tags = [
+            Tag.objects.create(name=name, color=color, slug=name)
+            for name, color in (('breakfast', '#E26C2D'), ('lunch', '#49B64E'))
+        ]
+        ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('мука', 'сахар', 'соль')
+        ]
+        create_recipes(author, 60, tags, ingredients)
+
+    def setUp(self):
+        cache.recipe_cache.backend = cache.get_backend()
+        self.anonymous = APIClient()
+        self.reader = APIClient()
+        self.reader.force_authenticate(self.user)
+
+    def get_recipes(self, client, limit, queries):
+        with self.assertNumQueries(queries):
+            response = client.get(f'/api/recipes/?limit={limit}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), limit)
+
+    def test_cold_cache(self):
+        for client in (self.anonymous, self.reader):
+            for limit in (3, 50):
+                with self.subTest(client=client, limit=limit):
+                    cache.recipe_cache.backend = cache.get_backend()
+                    self.get_recipes(client, limit, self.COLD_QUERIES)
+
+    def test_warm_cache(self):
+        self.anonymous.get('/api/recipes/?limit=50')
+        for client in (self.anonymous, self.reader):
+            for limit in (3, 50):
+                with self.subTest(client=client, limit=limit):
+                    self.get_recipes(client, limit, self.WARM_QUERIES)
+
+    def test_same_queries_for_any_page_size(self):
+        for client in (self.anonymous, self.reader):
+            counts = []
+            for limit in (3, 50):
+                cache.recipe_cache.backend = cache.get_backend()
+                with CaptureQueriesContext(connection) as queries:
+                    client.get(f'/api/recipes/?limit={limit}')
+                counts.append(len(queries))
+            self.assertEqual(counts[0], counts[1])
+
+
+class RecipeFragmentCacheTest(TestCase):
+    """Измененный рецепт не отдается из кэша фрагментов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_recipes(create_user('author'), 1)
+
+    def setUp(self):
+        cache.recipe_cache.backend = cache.get_backend()
+        self.anonymous = APIClient()
+
+    def test_save_after_out_of_band_change(self):
+        recipe = Recipe.objects.first()
+        Recipe.objects.filter(pk=recipe.pk).update(version=F('version') + 1)
+        self.anonymous.get(f'/api/recipes/{recipe.pk}/')
+        recipe.name = 'Новое название'
+        recipe.save()
+        response = self.anonymous.get(f'/api/recipes/{recipe.pk}/')
+        self.assertEqual(response.data['name'], 'Новое название')
+
+
+class SubscriptionsQueriesTest(TestCase):
+    """Число запросов подписок не зависит от числа авторов."""
+
+    # Количество, страница авторов, их рецепты.
+    QUERIES = 3
+    RECIPES = 3
+    RECIPES_LIMIT = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.authors = User.objects.bulk_create(
+            User(
+                username=f'author{number:04}',
+                email=f'author{number:04}@example.com',
+                first_name='Автор',
+                last_name='Автор',
+            )
+            for number in range(1000)
+        )
+        Recipe.objects.bulk_create(
+            Recipe(
+                author=author,
+                name=f'{author.username} {number}',
+                text='Описание',
+                cooking_time=10,
+                image=f'recipes/image/{author.username}-{number}.png',
+            )
+            for author in cls.authors for number in range(cls.RECIPES)
+        )
+        # bulk_create не обновляет счетчики: их пересчитывает команда.
+        call_command('reconcile_counters', stdout=StringIO())
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def follow(self, authors):
+        Follow.objects.bulk_create(
+            Follow(user=self.user, author=author) for author in authors
+        )
+
+    def get_subscriptions(self):
+        """Все страницы подписок; на каждую одно и то же число запросов."""
+        authors, url = [], (
+            '/api/users/subscriptions/'
+            f'?limit=100&recipes_limit={self.RECIPES_LIMIT}'
+        )
+        while url:
+            with self.assertNumQueries(self.QUERIES):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            authors.extend(response.data['results'])
+            url = response.data['next']
+        return authors
+
+    def check_subscriptions(self, count):
+        authors = self.get_subscriptions()
+        self.assertEqual(len(authors), count)
+        for author in authors:
+            self.assertIs(author['is_subscribed'], True)
+            self.assertEqual(author['recipes_count'], self.RECIPES)
+            self.assertEqual(len(author['recipes']), self.RECIPES_LIMIT)
+
+    def test_subscriptions(self):
+        self.follow(self.authors[:100])
+        self.check_subscriptions(100)
+        self.follow(self.authors[100:])
+        self.check_subscriptions(1000)
+
+
+class ShoppingCartDownloadTest(TestCase):
+    """Список покупок суммирует продукты только из своей корзины."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('buyer')
+        other = create_user('other')
+        author = create_user('author')
+        flour = Ingredient.objects.create(name='мука', measurement_unit='г')
+        salt = Ingredient.objects.create(name='соль', measurement_unit='г')
+        recipes = create_recipes(author, 2, ingredients=[flour])
+        salted = create_recipes(author, 1, ingredients=[flour, salt])
+        for recipe in recipes:
+            ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+        for recipe in (*recipes, *salted):
+            ShoppingCart.objects.create(user=other, recipe=recipe)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def download(self, export_format):
+        return self.client.get(
+            '/api/recipes/download_shopping_cart/',
+            {'format': export_format}
+        )
+
+    def content(self, export_format):
+        response = self.download(export_format)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_txt(self):
+        lines = self.content('txt').splitlines()
+        start = lines.index('ПРОДУКТЫ:') + 1
+        products = lines[start:lines.index('', start)]
+        self.assertEqual(products, ['1.200 г - Мука'])
+
+    def test_csv(self):
+        rows = list(csv.reader(self.content('csv').splitlines()))
+        self.assertEqual(rows[1:], [['мука', '200', 'г']])
+
+    def test_pdf(self):
+        response = self.download('pdf')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(
+            b'%PDF'
+        ))
+
+    def test_unknown_format(self):
+        self.assertEqual(self.download('xlsx').status_code, 400)
+
+
+class RecipeCursorTest(TestCase):
+    """Курсор листает только по дате публикации."""
+
+    @classmethod
+    def setUpTestData(cls):
+        create_recipes(create_user('author'), 5)
+
+    def test_date_order(self):
+        client = APIClient()
+        ids, url = [], '/api/recipes/?cursor=&limit=2'
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(recipe['id'] for recipe in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_other_orders_rejected(self):
+        client = APIClient()
+        for query in (
+            'ordering=popular', 'ordering=trending', 'search=author'
+        ):
+            with self.subTest(query=query):
+                response = client.get(f'/api/recipes/?{query}&cursor=')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('cursor', response.data)
+
+
+class IngredientSearchTest(TestCase):
+    """Подсказки продуктов отдаются из индекса в памяти."""
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('молоко', 'молоко сгущенное', 'мука', 'сахар'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def search(self, name):
+        response = APIClient().get('/api/ingredients/', {'name': name})
+        self.assertEqual(response.status_code, 200)
+        return [ingredient['name'] for ingredient in response.data]
+
+    def test_prefix(self):
+        self.search('мол')
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.search('мол'), ['молоко', 'молоко сгущенное']
+            )
+
+    def test_typo(self):
+        self.search('мол')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search('малоко')[0], 'молоко')
+
+
+class TrendingScoreTest(TestCase):
+    """Удаление из избранного и списка покупок снимает рейтинг трендов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.recipe, = create_recipes(create_user('author'), 1)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def score(self):
+        self.recipe.refresh_from_db(fields=('trending_score',))
+        return self.recipe.trending_score
+
+    def test_toggling_does_not_raise_score(self):
+        for action in ('favorite', 'shopping_cart'):
+            with self.subTest(action=action):
+                url = f'/api/recipes/{self.recipe.pk}/{action}/'
+                bulk_url = f'/api/recipes/{action}/bulk/'
+                ids = {'ids': [self.recipe.pk]}
+                for _ in range(3):
+                    self.client.post(url)
+                    self.client.delete(url)
+                    self.client.post(bulk_url, ids, format='json')
+                    self.client.delete(bulk_url, ids, format='json')
+                self.assertEqual(self.score(), 0)
+                self.client.post(url)
+                self.assertGreater(self.score(), 0)
+                self.client.delete(url)
+                self.assertEqual(self.score(), 0)
+
+
+@override_settings(FEED_FANOUT_LIMIT=0, FEED_BACKFILL=2)
+class FeedPullTest(TestCase):
+    """Рецепты популярных авторов подтягиваются в ленту при чтении."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.authors = [create_user(f'author{number}') for number in range(10)]
+        for author in cls.authors:
+            create_recipes(author, 3)
+        User.objects.filter(
+            pk__in=[author.pk for author in cls.authors]
+        ).update(followers_count=1)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def follow(self, authors):
+        Follow.objects.bulk_create(
+            Follow(user=self.user, author=author) for author in authors
+        )
+
+    def read_feed(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/recipes/feed/?limit=100')
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'], len(queries)
+
+    def test_queries_do_not_depend_on_authors(self):
+        self.follow(self.authors[:3])
+        recipes, few = self.read_feed()
+        self.assertEqual(len(recipes), 3 * 2)
+        FeedEntry.objects.all().delete()
+        self.follow(self.authors[3:])
+        recipes, many = self.read_feed()
+        self.assertEqual(len(recipes), 10 * 2)
+        self.assertEqual(few, many)
+
+    def test_pulls_only_new_recipes(self):
+        self.follow(self.authors)
+        self.read_feed()
+        self.read_feed()
+        self.assertEqual(FeedEntry.objects.count(), 10 * 2)
+        recipe, = create_recipes(self.authors[0], 1)
+        recipes, _ = self.read_feed()
+        self.assertEqual(recipes[0]['id'], recipe.id)
+        self.assertEqual(FeedEntry.objects.count(), 10 * 2 + 1)
+
+
+class DenormalizedDataTest(TestCase):
+    """Списки покупок и счетчики не расходятся с исходными данными
+    после любых изменений."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            email='admin@example.com', username='admin', password='admin',
+            first_name='admin', last_name='admin'
+        )
+        cls.buyer = create_user('buyer')
+        cls.other = create_user('other')
+        cls.author = create_user('author')
+        cls.tag = Tag.objects.create(
+            name='lunch', color='#49B64E', slug='lunch'
+        )
+        cls.flour, cls.salt, cls.sugar = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('мука', 'соль', 'сахар')
+        )
+        cls.recipes = [
+            cls.create_recipe(cls.author, 'первый', (cls.flour, cls.salt)),
+            cls.create_recipe(cls.author, 'второй', (cls.flour,)),
+            cls.create_recipe(cls.author, 'третий', (cls.sugar,)),
+            cls.create_recipe(cls.buyer, 'свой', (cls.salt, cls.sugar)),
+        ]
+        for user in (cls.buyer, cls.other):
+            for recipe in cls.recipes[:2]:
+                ShoppingCart.objects.create(user=user, recipe=recipe)
+                Favorite.objects.create(user=user, recipe=recipe)
+            Follow.objects.create(user=user, author=cls.author)
+        ShoppingCart.objects.create(user=cls.other, recipe=cls.recipes[3])
+        Follow.objects.create(user=cls.other, author=cls.buyer)
+
+    @classmethod
+    def create_recipe(cls, author, name, ingredients):
+        recipe = Recipe.objects.create(
+            author=author,
+            name=name,
+            text='Описание',
+            cooking_time=10,
+            image=f'recipes/image/{name}.png',
+        )
+        recipe.tags.add(cls.tag)
+        IngredientAmount.objects.bulk_create(
+            IngredientAmount(recipe=recipe, ingredient=ingredient, amount=100)
+            for ingredient in ingredients
+        )
+        return recipe
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+        self.admin_client = APIClient()
+        self.admin_client.force_login(self.admin)
+
+    def assertNoDrift(self):
+        for command in ('rebuild_shopping_lists', 'reconcile_counters'):
+            output = StringIO()
+            call_command(command, verify=True, stdout=output)
+            drift = re.findall(r'расхождени\w*: (\d+)', output.getvalue())
+            self.assertTrue(drift, output.getvalue())
+            self.assertEqual(set(drift), {'0'}, output.getvalue())
+
+    def links(self):
+        first, _, third, _ = self.recipes
+        return (
+            (f'/api/recipes/{first.pk}/shopping_cart/',
+             f'/api/recipes/{third.pk}/shopping_cart/'),
+            (f'/api/recipes/{first.pk}/favorite/',
+             f'/api/recipes/{third.pk}/favorite/'),
+            (f'/api/users/{self.author.pk}/subscribe/',
+             f'/api/users/{self.other.pk}/subscribe/'),
+        )
+
+    def test_fixture(self):
+        self.assertNoDrift()
+
+    def test_single_links(self):
+        for existing, added in self.links():
+            with self.subTest(url=added):
+                self.assertEqual(self.client.post(added).status_code, 201)
+                self.assertNoDrift()
+                for url in (added, existing):
+                    self.assertEqual(
+                        self.client.delete(url).status_code, 204
+                    )
+                    self.assertNoDrift()
+
+    def test_bulk_links(self):
+        recipe_ids = [recipe.pk for recipe in self.recipes[:3]]
+        for url, ids in (
+            ('/api/recipes/shopping_cart/bulk/', recipe_ids),
+            ('/api/recipes/favorite/bulk/', recipe_ids),
+            ('/api/users/subscribe/bulk/', [self.author.pk, self.other.pk]),
+        ):
+            with self.subTest(url=url):
+                for method in (self.client.post, self.client.delete):
+                    response = method(url, {'ids': ids}, format='json')
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNoDrift()
+
+    def test_admin_bulk_delete(self):
+        for model in (ShoppingCart, Favorite, Follow):
+            with self.subTest(model=model.__name__):
+                response = self.admin_client.post(
+                    f'/admin/recipes/{model._meta.model_name}/',
+                    {
+                        'action': 'delete_selected',
+                        'post': 'yes',
+                        '_selected_action': list(
+                            model.objects.filter(
+                                user=self.buyer
+                            ).values_list('pk', flat=True)
+                        ),
+                    }
+                )
+                self.assertEqual(response.status_code, 302)
+                self.assertFalse(
+                    model.objects.filter(user=self.buyer).exists()
+                )
+                self.assertNoDrift()
+
+    def test_recipe_deleted(self):
+        client = APIClient()
+        client.force_authenticate(self.author)
+        response = client.delete(f'/api/recipes/{self.recipes[0].pk}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertNoDrift()
+
+    def test_users_deleted(self):
+        for user in (self.buyer, self.author):
+            with self.subTest(user=user.username):
+                user.delete()
+                self.assertNoDrift()
+
+    def test_ingredients_patched(self):
+        client = APIClient()
+        client.force_authenticate(self.author)
+        response = client.patch(
+            f'/api/recipes/{self.recipes[0].pk}/',
+            {'ingredients': [
+                {'id': self.flour.pk, 'amount': 250},
+                {'id': self.sugar.pk, 'amount': 10},
+            ]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNoDrift()
+
+    def test_admin_save_related(self):
+        recipe = self.recipes[0]
+        rows = list(recipe.ingredientinrecipes.order_by('pk'))
+        prefix = 'ingredientinrecipes'
+        data = {
+            'author': self.author.pk,
+            'name': recipe.name,
+            'text': recipe.text,
+            'cooking_time': recipe.cooking_time,
+            'tags': [self.tag.pk],
+            f'{prefix}-TOTAL_FORMS': 3,
+            f'{prefix}-INITIAL_FORMS': 2,
+            f'{prefix}-MIN_NUM_FORMS': 1,
+            f'{prefix}-MAX_NUM_FORMS': 1000,
+        }
+        for number, (row, ingredient, amount, delete) in enumerate((
+            (rows[0], self.flour, 300, ''),
+            (rows[1], self.salt, 100, 'on'),
+            (None, self.sugar, 50, ''),
+        )):
+            data.update({
+                f'{prefix}-{number}-id': row.pk if row else '',
+                f'{prefix}-{number}-recipe': recipe.pk,
+                f'{prefix}-{number}-ingredient': ingredient.pk,
+                f'{prefix}-{number}-amount': amount,
+                f'{prefix}-{number}-DELETE': delete,
+            })
+        response = self.admin_client.post(
+            f'/admin/recipes/recipe/{recipe.pk}/change/', data
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            recipe.ingredient_amounts(),
+            {self.flour.pk: 300, self.sugar.pk: 50}
+        )
+        self.assertNoDrift()
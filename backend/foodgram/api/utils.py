@@ -1,45 +1,89 @@
+import csv
 import datetime
-from django.db.models import Sum
+from tempfile import SpooledTemporaryFile
 
-from recipes.models import IngredientAmount
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen.canvas import Canvas
 
+from recipes.models import Recipe
 
-def generate_shopping_cart_message(shopping_cart_list):
-    ingredient_names = set(
-        item['ingredient__name'] for item in shopping_cart_list)
-    ingredient_amounts = (
-        IngredientAmount.objects
-        .filter(ingredient__name__in=ingredient_names)
-        .values('ingredient__name', 'ingredient__measurement_unit')
-        .annotate(total_sum=Sum('amount'))
-    )
-    ingredients = {
-        (item["ingredient__name"],
-         item["ingredient__measurement_unit"]): item['total_sum']
-        for item in ingredient_amounts
-    }
-    return '\n'.join(
-        [
-            f'Дата: {datetime.date.today().isoformat()}',
-            '',
-            'ПРОДУКТЫ:',
-            *[
-                f'{index + 1}.'
-                f'{amount}'
-                f' {measurement_unit}'
-                f' - {name.capitalize()}'
-                for index, ((name, measurement_unit), amount) in enumerate(
-                    ingredients.items()
-                )
-            ],
-            '',
-            'РЕЦЕПТЫ:',
-            *[
-                f'{index + 1}.'
-                f'{item.capitalize()}'
-                for index, item in enumerate(
-                    set(item["recipe__name"] for item in shopping_cart_list)
-                )
-            ],
-        ]
+PDF_FONT = 'ShoppingListFont'
+PDF_FONT_SIZE = 12
+PDF_MARGIN = 50
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def shopping_cart_lines(user):
+    yield f'Дата: {datetime.date.today().isoformat()}'
+    yield ''
+    yield 'ПРОДУКТЫ:'
+    for index, item in enumerate(
+        Recipe.create_shopping_cart_list(user).iterator(), 1
+    ):
+        yield (
+            f'{index}.{item["amount"]}'
+            f' {item["ingredient__measurement_unit"]}'
+            f' - {item["ingredient__name"].capitalize()}'
+        )
+    yield ''
+    yield 'РЕЦЕПТЫ:'
+    for index, name in enumerate(
+        Recipe.objects.filter(shoppingcarts__user=user).values_list(
+            'name', flat=True
+        ).iterator(), 1
+    ):
+        yield f'{index}.{name.capitalize()}'
+
+
+def shopping_cart_txt(user):
+    for line in shopping_cart_lines(user):
+        yield f'{line}\n'
+
+
+def shopping_cart_csv(user):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('Продукт', 'Количество', 'Единица измерения'))
+    for item in Recipe.create_shopping_cart_list(user).iterator():
+        yield writer.writerow((
+            item['ingredient__name'],
+            item['amount'],
+            item['ingredient__measurement_unit'],
+        ))
+
+
+def shopping_cart_pdf(user):
+    if PDF_FONT not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(
+            TTFont(PDF_FONT, settings.SHOPPING_LIST_PDF_FONT)
+        )
+    pdf_file = SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE
     )
+    canvas = Canvas(pdf_file, pagesize=A4)
+    width, height = A4
+    canvas.setFont(PDF_FONT, PDF_FONT_SIZE)
+    top = height - PDF_MARGIN
+    for line in shopping_cart_lines(user):
+        if top < PDF_MARGIN:
+            canvas.showPage()
+            canvas.setFont(PDF_FONT, PDF_FONT_SIZE)
+            top = height - PDF_MARGIN
+        canvas.drawString(PDF_MARGIN, top, line)
+        top -= PDF_FONT_SIZE * 1.5
+    canvas.save()
+    pdf_file.seek(0)
+    return pdf_file
+
+
+SHOPPING_CART_FORMATS = {
+    'txt': (shopping_cart_txt, 'text/plain; charset=utf-8'),
+    'csv': (shopping_cart_csv, 'text/csv; charset=utf-8'),
+    'pdf': (shopping_cart_pdf, 'application/pdf'),
+}
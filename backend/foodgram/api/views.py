@@ -1,40 +1,104 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Value
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
-from django.http import FileResponse
+from django_filters.utils import translate_validation
+from django.http import (FileResponse, HttpResponse,
+                         HttpResponseNotModified, StreamingHttpResponse)
+from django.utils.http import parse_etags
 from djoser.views import UserViewSet as BaseUserViewSet
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.permissions import (IsAuthenticated,
+from rest_framework.exceptions import ValidationError
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.permissions import (IsAdminUser, IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
 
-from api.filters import IngredientFilter, RecipeFilter
-from api.pagination import Pagination
+from api.cache import facets_key, recipe_cache, reference_cache
+from api.filters import RecipeFilter
+from api.idempotency import idempotent
+from api.indexes import ingredient_index
+from api.pagination import KeysetPagination, Pagination
 from api.permissions import IsAuthorOrSafePermission
 from api.serializers import (
-    CreateRecipeSerializer, FavoriteSerializer,
+    BulkIdsSerializer, CreateRecipeSerializer, FavoriteSerializer,
     IngredientSerializer, ReadRecipeSerializer,
     ShoppingCartSerializer, SubscribesSerializer,
     TagSerializer, UserSerializer
 )
-from api.utils import generate_shopping_cart_message
+from api.utils import SHOPPING_CART_FORMATS
+from recipes import timeline
 from recipes.models import (
-    Favorite, Follow,
+    DataVersion, Favorite, Follow,
     Ingredient, Recipe,
     ShoppingCart, Tag, User
 )
+from recipes.signals import bulk_created, bulk_deleted
+
+
+class IgnoreFormatNegotiation(DefaultContentNegotiation):
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+
+def bulk_change(request, model, field, targets):
+    """Добавляет или удаляет связи пользователя с объектами targets
+    по списку ids и возвращает результат для каждого id."""
+    serializer = BulkIdsSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    ids = list(dict.fromkeys(serializer.validated_data['ids']))
+    found = set(targets.filter(id__in=ids).values_list('id', flat=True))
+    result = dict.fromkeys(ids, 'not_found')
+    with transaction.atomic():
+        # Связи читаются под блокировкой пользователя: параллельный запрос
+        # дождется коммита и увидит уже добавленные или удаленные строки.
+        User.lock(request.user.pk)
+        links = {
+            getattr(link, f'{field}_id'): link
+            for link in model.objects.filter(
+                user=request.user, **{f'{field}_id__in': found}
+            )
+        }
+        if request.method == 'POST':
+            created = []
+            for pk in ids:
+                if pk in links:
+                    result[pk] = 'exists'
+                elif pk in found:
+                    result[pk] = 'created'
+                    created.append(
+                        model(user=request.user, **{f'{field}_id': pk})
+                    )
+            model.objects.bulk_create(created)
+            bulk_created.send(sender=model, instances=created)
+        else:
+            for pk in found:
+                result[pk] = 'deleted' if pk in links else 'missing'
+            bulk_deleted.send(sender=model, instances=list(links.values()))
+            model.objects.filter(
+                pk__in=[link.pk for link in links.values()]
+            ).delete()
+    return Response([
+        {'id': pk, 'status': result_status}
+        for pk, result_status in result.items()
+    ])
 
 
 class UserViewSet(BaseUserViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     pagination_class = Pagination
+    cursor_ordering = ('username',)
 
     @action(
         detail=True,
         methods=['post', 'delete'],
         permission_classes=[IsAuthenticated],
     )
+    @idempotent
     def subscribe(self, request, id):
         user = request.user
         author = get_object_or_404(User, pk=id)
@@ -44,39 +108,104 @@ class UserViewSet(BaseUserViewSet):
                 author, data=request.data, context={'request': request}
             )
             serializer.is_valid(raise_exception=True)
-            Follow.objects.create(user=user, author=author)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            serializer.create_follow()
+            return Response(
+                SubscribesSerializer(
+                    self.get_subscriptions(request).get(pk=author.pk),
+                    context={'request': request}
+                ).data,
+                status=status.HTTP_201_CREATED
+            )
 
         if request.method == 'DELETE':
-            get_object_or_404(
-                Follow, user=user, author=author
-            ).delete()
+            with transaction.atomic():
+                User.lock(user.pk)
+                get_object_or_404(
+                    Follow, user=user, author=author
+                ).delete()
             return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(
+        detail=False,
+        methods=['post', 'delete'],
+        permission_classes=[IsAuthenticated],
+        url_path='subscribe/bulk',
+        url_name='subscribe-bulk',
+    )
+    @idempotent
+    def subscribe_bulk(self, request):
+        return bulk_change(
+            request, Follow, 'author', User.objects.exclude(pk=request.user.pk)
+        )
+
+    @staticmethod
+    def get_subscriptions(request):
+        recipes = Recipe.objects.all()
+        limit = request.query_params.get('recipes_limit', '')
+        if limit.isdigit():
+            recipes = recipes[:int(limit)]
+        return User.objects.filter(following__user=request.user).annotate(
+            is_subscribed=Value(True),
+        ).prefetch_related(
+            Prefetch('recipes', queryset=recipes, to_attr='limited_recipes')
+        ).order_by('username')
+
     @action(detail=False, permission_classes=[IsAuthenticated])
     def subscriptions(self, request):
-        subscriptions = User.objects.filter(following__user=request.user)
-        pages = self.paginate_queryset(subscriptions)
+        pages = self.paginate_queryset(self.get_subscriptions(request))
         serializer = SubscribesSerializer(
             pages, many=True, context={'request': request}
         )
         return self.get_paginated_response(serializer.data)
 
 
-class TagViewSet(viewsets.ModelViewSet):
+class ReferenceDataMixin:
+    reference_name = None
+
+    def list(self, request, *args, **kwargs):
+        entry = reference_cache.get(
+            self.reference_name,
+            DataVersion.get(self.reference_name),
+            lambda: self.get_serializer(self.get_queryset(), many=True).data
+        )
+        if entry.etag in parse_etags(
+            request.headers.get('If-None-Match', '')
+        ):
+            response = HttpResponseNotModified()
+        elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response = HttpResponse(
+                entry.compressed, content_type='application/json'
+            )
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(
+                entry.body, content_type='application/json'
+            )
+        response['ETag'] = entry.etag
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
+
+class TagViewSet(ReferenceDataMixin, viewsets.ModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
     pagination_class = None
+    reference_name = DataVersion.TAGS
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ReferenceDataMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = IngredientSerializer
     queryset = Ingredient.objects.all()
     permission_classes = (IsAuthenticatedOrReadOnly,)
-    filter_backends = (IngredientFilter,)
-    search_fields = ('^name',)
     pagination_class = None
+    reference_name = DataVersion.INGREDIENTS
+
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if name:
+            return Response(ingredient_index.search(name))
+        return super().list(request, *args, **kwargs)
 
 
 class RecipeViewSet(viewsets.ModelViewSet):
@@ -87,6 +216,39 @@ class RecipeViewSet(viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
 
+    def get_queryset(self):
+        user = self.request.user
+
+        def flag(model, **lookups):
+            if user.is_anonymous:
+                return Value(False)
+            return Exists(model.objects.filter(user=user, **lookups))
+
+        return Recipe.objects.defer('search_vector').prefetch_related(
+            Prefetch(
+                'author',
+                queryset=User.objects.annotate(
+                    is_subscribed=flag(Follow, author=OuterRef('pk'))
+                )
+            ),
+        ).annotate(
+            is_favorited=flag(Favorite, recipe=OuterRef('pk')),
+            is_in_shopping_cart=flag(ShoppingCart, recipe=OuterRef('pk')),
+        )
+
+    def get_cursor_ordering(self):
+        params = self.request.query_params
+        if params.get('ordering') or params.get('search') or (
+            params.get('ingredients') and params.get('match') == 'most'
+        ):
+            # Курсор хранит только первое поле сортировки, а у рейтингов и
+            # релевантности много равных значений: страницы бы повторялись.
+            raise ValidationError({'cursor': [
+                'Вывод по курсору доступен только по дате публикации, '
+                'используйте page'
+            ]})
+        return KeysetPagination.ordering
+
     def get_serializer_class(self):
         if self.request.method == 'GET':
             return ReadRecipeSerializer
@@ -95,39 +257,103 @@ class RecipeViewSet(viewsets.ModelViewSet):
     @staticmethod
     def add_recipe_to(request, pk, serializer):
         recipe = get_object_or_404(Recipe, id=pk)
-        serializer = serializer(
-            data={
-                'user': request.user.id,
-                'recipe': recipe.id
-            },
-            context={'request': request}
-        )
+        serializer = serializer(data={}, context={'request': request})
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        serializer.save(user=request.user, recipe=recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @staticmethod
+    @transaction.atomic
     def destroy_recipe_from(request, pk, model):
+        User.lock(request.user.pk)
         get_object_or_404(
             model,
             user=request.user,
             recipe=get_object_or_404(Recipe, id=pk)
         ).delete()
 
-    @action(detail=False, methods=['GET'])
+    @action(
+        detail=False,
+        methods=['GET'],
+        permission_classes=[IsAuthenticated],
+        content_negotiation_class=IgnoreFormatNegotiation,
+    )
     def download_shopping_cart(self, request):
-        return FileResponse(
-            generate_shopping_cart_message(
-                Recipe.create_shopping_cart_list(self.request.user)
-            ),
-            content_type='text/plain'
+        export_format = request.query_params.get('format', 'txt')
+        if export_format not in SHOPPING_CART_FORMATS:
+            return Response(
+                {'format': f'Доступные форматы: '
+                           f'{", ".join(SHOPPING_CART_FORMATS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        export, content_type = SHOPPING_CART_FORMATS[export_format]
+        content = export(request.user)
+        response_class = (
+            FileResponse if hasattr(content, 'read')
+            else StreamingHttpResponse
+        )
+        response = response_class(content, content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="shopping_list.{export_format}"'
+        )
+        return response
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def feed(self, request):
+        paginator = KeysetPagination()
+        paginator.ordering = ('-feed_date', '-id')
+        if not request.query_params.get(paginator.cursor_query_param):
+            timeline.pull(request.user)
+        recipes = self.get_queryset().filter(
+            feed_entries__user=request.user
+        ).annotate(feed_date=F('feed_entries__pub_date'))
+        serializer = ReadRecipeSerializer(
+            paginator.paginate_queryset(recipes, request, self),
+            many=True,
+            context={'request': request}
+        )
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False)
+    def facets(self, request):
+        filterset = RecipeFilter(
+            request.query_params,
+            queryset=Recipe.objects.all(),
+            request=request
+        )
+        if not filterset.is_valid():
+            raise translate_validation(filterset.errors)
+        cache = caches[settings.FACETS_CACHE]
+        key = facets_key(
+            request.query_params, filterset.filters, request.user
         )
+        data = cache.get(key)
+        if data is None:
+            data = filterset.facets()
+            cache.set(key, data, settings.FACETS_CACHE_TIMEOUT)
+        return Response(data)
+
+    @action(detail=True)
+    def similar(self, request, pk):
+        recipe = get_object_or_404(Recipe, id=pk)
+        recipes = self.get_queryset().filter(
+            similar_to__recipe=recipe
+        ).order_by('-similar_to__similarity', '-id')
+        serializer = ReadRecipeSerializer(
+            recipes, many=True, context={'request': request}
+        )
+        return Response(serializer.data)
+
+    @action(detail=False, permission_classes=[IsAdminUser])
+    def cache_stats(self, request):
+        return Response(recipe_cache.stats())
 
     @action(
         detail=True,
         methods=('POST',),
         permission_classes=[IsAuthenticated]
     )
+    @idempotent
     def shopping_cart(self, request, pk):
         return self.add_recipe_to(request, pk, ShoppingCartSerializer)
 
@@ -136,9 +362,32 @@ class RecipeViewSet(viewsets.ModelViewSet):
         methods=('POST',),
         permission_classes=[IsAuthenticated]
     )
+    @idempotent
     def favorite(self, request, pk):
         return self.add_recipe_to(request, pk, FavoriteSerializer)
 
+    @action(
+        detail=False,
+        methods=('POST', 'DELETE'),
+        permission_classes=[IsAuthenticated],
+        url_path='shopping_cart/bulk',
+        url_name='shopping-cart-bulk',
+    )
+    @idempotent
+    def shopping_cart_bulk(self, request):
+        return bulk_change(request, ShoppingCart, 'recipe', Recipe.objects)
+
+    @action(
+        detail=False,
+        methods=('POST', 'DELETE'),
+        permission_classes=[IsAuthenticated],
+        url_path='favorite/bulk',
+        url_name='favorite-bulk',
+    )
+    @idempotent
+    def favorite_bulk(self, request):
+        return bulk_change(request, Favorite, 'recipe', Recipe.objects)
+
     @shopping_cart.mapping.delete
     def destroy_shopping_cart(self, request, pk):
         self.destroy_recipe_from(request, pk, ShoppingCart)
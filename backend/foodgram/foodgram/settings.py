@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -21,6 +22,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'api.apps.ApiConfig',
@@ -139,3 +141,57 @@ DJOSER = {
 
     "HIDE_USERS": False,
 }
+
+RECIPE_CACHE_BACKEND = os.getenv('RECIPE_CACHE_BACKEND', 'locmem')
+RECIPE_CACHE_SIZE = int(os.getenv('RECIPE_CACHE_SIZE', 1000))
+RECIPE_CACHE_TIMEOUT = 60 * 60 * 24
+
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 1000))
+FEED_BATCH_SIZE = 500
+FEED_BACKFILL = 20
+
+INGREDIENT_SEARCH_LIMIT = int(os.getenv('INGREDIENT_SEARCH_LIMIT', 50))
+INGREDIENT_SIMILARITY_THRESHOLD = 0.5
+# Как часто воркер сверяет индекс продуктов с версией справочника, сек.
+INGREDIENT_VERSION_CHECK_INTERVAL = 5
+
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
+# Для нескольких воркеров нужен общий кэш (например, Redis) в CACHES.
+IDEMPOTENCY_CACHE = os.getenv('IDEMPOTENCY_CACHE', 'default')
+IDEMPOTENCY_TIMEOUT = 60 * 60 * 24
+IDEMPOTENCY_LOCK_TIMEOUT = 30
+
+# Уменьшенные копии изображений рецептов: {вариант: сторона или None}.
+IMAGE_VARIANTS = {'thumb': 320, 'card': 640, 'full': None}
+IMAGE_WEBP_QUALITY = 80
+IMAGE_PROCESSING_WORKERS = int(os.getenv('IMAGE_PROCESSING_WORKERS', 2))
+
+# Счетчики фасетов для фильтра рецептов кэшируются ненадолго.
+FACETS_CACHE = os.getenv('FACETS_CACHE', 'default')
+FACETS_CACHE_TIMEOUT = 60
+
+# Похожие рецепты: сколько хранить на рецепт, минимальное сходство,
+# в скольких рецептах продукт уже не учитывается в сходстве
+# и сколько пар рецептов считать за один шаг.
+RECIPE_NEIGHBOURS = 10
+RECIPE_NEIGHBOURS_MIN_SIMILARITY = 0.2
+RECIPE_NEIGHBOURS_MAX_FREQUENCY = 10000
+RECIPE_NEIGHBOURS_MAX_PAIRS = 2000000
+
+# Рейтинг трендов: вклад добавления в избранное и в список покупок,
+# период полураспада и значение, ниже которого рейтинг обнуляется.
+TRENDING_FAVORITE_WEIGHT = 1.0
+TRENDING_SHOPPING_CART_WEIGHT = 1.0
+TRENDING_HALF_LIFE = timedelta(days=1)
+TRENDING_MIN_SCORE = 0.01
+
+# Подбор рецептов по продуктам: индекс в памяти или запросы к БД.
+RECIPE_INGREDIENT_INDEX = os.getenv(
+    'RECIPE_INGREDIENT_INDEX', 'True'
+).lower() == 'true'
+RECIPE_MATCH_LIMIT = 1000
+RECIPE_MATCH_MOST_COVERAGE = 0.5
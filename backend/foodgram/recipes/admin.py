@@ -2,12 +2,16 @@ from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models import Case, Count, Prefetch, When
 from django.utils.safestring import mark_safe
 
+from api.indexes import ingredient_index
 from recipes.models import (
     Favorite, Follow, Ingredient, IngredientAmount,
-    Recipe, ShoppingCart, Tag, User
+    Recipe, ShoppingCart, ShoppingListItem, Tag, User
 )
+from recipes.signals import bulk_deleted
 
 
 class CookingTimeFilter(SimpleListFilter):
@@ -15,29 +19,26 @@ class CookingTimeFilter(SimpleListFilter):
     parameter_name = 'cooking_time'
 
     def lookups(self, request, model_admin):
-        lookup_choices = []
-        thresholds = [15, 45]
-
-        for low, high, label in [
-            (0, thresholds[0], f'Быстрые (до {thresholds[0]} мин.)'),
-            (thresholds[0], thresholds[1],
-             f'Средние (от {thresholds[0]} до {thresholds[1]} мин.)'),
-            (thresholds[1], 10 ** 10, f'Долгие (больше {thresholds[1]} мин.)')
-        ]:
-            recipe_count = model_admin.get_queryset(request).filter(
-                cooking_time__range=(low, high)).count()
-
-            lookup_choices.append(
-                (f'{low + 1}-{high}', f'{label}, всего: {recipe_count}')
-            )
-
-        return lookup_choices
+        counts = model_admin.get_queryset(request).aggregate(**{
+            name: Count('pk', filter=Recipe.cooking_time_q(name))
+            for name, *_ in Recipe.COOKING_TIME_BUCKETS
+        })
+        return [
+            (name, f'{label}, всего: {counts[name]}')
+            for name, _, _, label in Recipe.COOKING_TIME_BUCKETS
+        ]
 
     def queryset(self, request, queryset):
         value = self.value()
-        if value:
-            low, high = map(int, value.split('-'))
-            return queryset.filter(cooking_time__range=(low, high))
+        if value in {name for name, *_ in Recipe.COOKING_TIME_BUCKETS}:
+            return queryset.filter(Recipe.cooking_time_q(value))
+
+
+class BulkDeleteMixin:
+    @transaction.atomic
+    def delete_queryset(self, request, queryset):
+        bulk_deleted.send(sender=self.model, instances=list(queryset))
+        super().delete_queryset(request, queryset)
 
 
 @admin.register(User)
@@ -60,23 +61,24 @@ class UserAdmin(UserAdmin):
     def get_name(self, user):
         return f'{user.first_name} {user.last_name}'
 
-    @admin.display(description='Рецептов')
+    @admin.display(description='Рецептов', ordering='recipes_count')
     def get_recipes(self, user):
-        return user.recipes.count()
+        return user.recipes_count
 
-    @admin.display(description='Подписок')
+    @admin.display(description='Подписок', ordering='following_count')
     def get_following(self, user):
-        return user.follower.count()
+        return user.following_count
 
-    @admin.display(description='Подписчиков')
+    @admin.display(description='Подписчиков', ordering='followers_count')
     def get_followers(self, user):
-        return user.following.count()
+        return user.followers_count
 
 
 @admin.register(Follow)
-class FollowAdmin(admin.ModelAdmin):
+class FollowAdmin(BulkDeleteMixin, admin.ModelAdmin):
     model = Follow
     list_display = ('id', 'user', 'author')
+    list_select_related = ('user', 'author')
 
 
 @admin.register(Tag)
@@ -107,11 +109,26 @@ class IngredientAdmin(admin.ModelAdmin):
     list_filter = ('measurement_unit',)
     empty_value_display = '-пусто-'
 
+    def get_search_results(self, request, queryset, search_term):
+        # Подсказки в форме рецепта берутся из индекса в памяти.
+        if not search_term or request.resolver_match.url_name != (
+            'autocomplete'
+        ):
+            return super().get_search_results(
+                request, queryset, search_term
+            )
+        ids = [row['id'] for row in ingredient_index.search(search_term)]
+        return queryset.filter(pk__in=ids).order_by(
+            Case(*(When(pk=pk, then=position)
+                   for position, pk in enumerate(ids)))
+        ), False
+
 
 class IngredientInline(admin.TabularInline):
     model = IngredientAmount
     extra = 3
     min_num = 1
+    autocomplete_fields = ('ingredient',)
 
 
 @admin.register(Recipe)
@@ -126,13 +143,29 @@ class RecipeAdmin(admin.ModelAdmin):
         'get_favorites',
         'get_image'
     )
-    search_fields = ('name', 'author', 'tags')
+    search_fields = ('name', 'author__username', 'tags__name')
     list_filter = ('tags__name', CookingTimeFilter,)
+    list_select_related = ('author',)
     inlines = (IngredientInline,)
 
-    @admin.display(description='В избранном')
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            'tags',
+            Prefetch(
+                'ingredientinrecipes',
+                queryset=IngredientAmount.objects.select_related('ingredient')
+            ),
+        )
+
+    def save_related(self, request, form, formsets, change):
+        old_amounts = form.instance.ingredient_amounts() if change else {}
+        super().save_related(request, form, formsets, change)
+        if change:
+            ShoppingListItem.recipe_changed(form.instance, old_amounts)
+
+    @admin.display(description='В избранном', ordering='favorites_count')
     def get_favorites(self, recipe):
-        return recipe.favorites.count()
+        return recipe.favorites_count
 
     @mark_safe
     @admin.display(description='Теги')
@@ -154,18 +187,20 @@ class RecipeAdmin(admin.ModelAdmin):
 
 
 @admin.register(Favorite)
-class FavoriteAdmin(admin.ModelAdmin):
+class FavoriteAdmin(BulkDeleteMixin, admin.ModelAdmin):
     model = Favorite
     list_display = ('user', 'recipe')
-    search_fields = list_display
+    list_select_related = ('user', 'recipe')
+    search_fields = ('user__username', 'recipe__name')
     empty_value_display = '-пусто-'
 
 
 @admin.register(ShoppingCart)
-class ShoppingCartAdmin(admin.ModelAdmin):
+class ShoppingCartAdmin(BulkDeleteMixin, admin.ModelAdmin):
     model = ShoppingCart
     list_display = ('recipe', 'user')
-    search_fields = ('user',)
+    list_select_related = ('recipe', 'user')
+    search_fields = ('user__username', 'recipe__name')
     empty_value_display = '-пусто-'
 
 
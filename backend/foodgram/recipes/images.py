@@ -0,0 +1,91 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from threading import Lock
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from PIL import Image, ImageOps
+
+from recipes.models import Recipe
+from recipes.storage import recipe_image_storage
+
+logger = logging.getLogger(__name__)
+
+executor = None
+executor_lock = Lock()
+
+
+def variant_name(name, variant):
+    return f'{name}.{variant}.webp'
+
+
+def render_variants(path, sizes, quality):
+    """Выполняется в процессе пула: сохраняет рядом с исходным файлом
+    копии в WebP, уменьшенные до sizes {вариант: сторона или None}."""
+    with Image.open(path) as source:
+        image = ImageOps.exif_transpose(source)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    for variant, size in sizes.items():
+        copy = image.copy()
+        if size:
+            copy.thumbnail((size, size))
+        copy.save(variant_name(path, variant), 'WEBP', quality=quality)
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_PROCESSING_WORKERS
+            )
+    return executor
+
+
+def save_variants(recipe_id, name):
+    Recipe.objects.filter(pk=recipe_id, image=name).update(
+        image_variants={
+            'source': name,
+            **{
+                variant: variant_name(name, variant)
+                for variant in settings.IMAGE_VARIANTS
+            }
+        },
+        version=F('version') + 1
+    )
+
+
+def variants_rendered(recipe_id, name, future):
+    try:
+        future.result()
+        save_variants(recipe_id, name)
+    except Exception:
+        logger.exception('Не удалось обработать изображение %s', name)
+    finally:
+        connections.close_all()
+
+
+def process_image(recipe_id, name):
+    """Запускает подготовку копий изображения рецепта вне запроса.
+    При IMAGE_PROCESSING_WORKERS = 0 копии готовятся сразу."""
+    if all(
+        recipe_image_storage.exists(variant_name(name, variant))
+        for variant in settings.IMAGE_VARIANTS
+    ):
+        # Одинаковое изображение уже обработано для другого рецепта.
+        save_variants(recipe_id, name)
+        return
+    args = (
+        recipe_image_storage.path(name),
+        settings.IMAGE_VARIANTS,
+        settings.IMAGE_WEBP_QUALITY,
+    )
+    if not settings.IMAGE_PROCESSING_WORKERS:
+        render_variants(*args)
+        save_variants(recipe_id, name)
+        return
+    get_executor().submit(render_variants, *args).add_done_callback(
+        partial(variants_rendered, recipe_id, name)
+    )
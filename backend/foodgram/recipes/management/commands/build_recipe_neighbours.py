@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from recipes.similarity import rebuild_neighbours
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает похожие рецепты для рецептов, измененных '
+        'с прошлого запуска'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Пересчитать все рецепты'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--max-pairs',
+            type=int,
+            default=settings.RECIPE_NEIGHBOURS_MAX_PAIRS,
+            help='Сколько пар рецептов сравнивать за один шаг'
+        )
+
+    def handle(self, *args, full, batch_size, max_pairs, **options):
+        rebuilt = rebuild_neighbours(full, batch_size, max_pairs)
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано рецептов: {rebuilt}'
+        ))
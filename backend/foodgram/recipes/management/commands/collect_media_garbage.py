@@ -0,0 +1,86 @@
+import posixpath
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from recipes.images import variant_name
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет изображения рецептов и их уменьшенные копии, '
+        'на которые не ссылается ни один рецепт'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, что будет удалено'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=60 * 60,
+            help='Не удалять файлы, измененные менее указанного числа секунд'
+        )
+
+    def walk(self, directory):
+        directories, files = self.storage.listdir(directory)
+        for name in files:
+            yield posixpath.join(directory, name)
+        for subdirectory in directories:
+            yield from self.walk(posixpath.join(directory, subdirectory))
+
+    @staticmethod
+    def owner(name):
+        for variant in settings.IMAGE_VARIANTS:
+            suffix = variant_name('', variant)
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+        return name
+
+    def handle(self, *args, dry_run, batch_size, min_age, **options):
+        field = Recipe._meta.get_field('image')
+        self.storage = field.storage
+        directory = field.upload_to.rstrip('/')
+        checked = removed = freed = 0
+        if self.storage.exists(directory):
+            border = timezone.now() - timedelta(seconds=min_age)
+            batch = []
+            for name in self.walk(directory):
+                checked += 1
+                if self.storage.get_modified_time(name) > border:
+                    continue
+                batch.append(name)
+                if len(batch) == batch_size:
+                    removed, freed = self.collect(
+                        batch, dry_run, removed, freed
+                    )
+                    batch = []
+            removed, freed = self.collect(batch, dry_run, removed, freed)
+        action = 'Будет удалено' if dry_run else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Проверено файлов: {checked}. {action} файлов: {removed}, '
+            f'{freed / 2 ** 20:.1f} МБ'
+        ))
+
+    def collect(self, names, dry_run, removed, freed):
+        owners = {name: self.owner(name) for name in names}
+        referenced = set(
+            Recipe.objects.filter(image__in=set(owners.values())).values_list(
+                'image', flat=True
+            )
+        )
+        for name, owner in owners.items():
+            if owner in referenced:
+                continue
+            freed += self.storage.size(name)
+            removed += 1
+            if not dry_run:
+                self.storage.delete(name)
+        return removed, freed
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        'Уменьшает рейтинг трендов рецептов с учетом времени, прошедшего '
+        'с прошлого пересчета'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, batch_size, **options):
+        now = timezone.now()
+        decayed = cleared = last_pk = 0
+        while True:
+            pks = list(Recipe.objects.filter(
+                pk__gt=last_pk, trending_score__gt=0
+            ).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            cleared += self.decay(Recipe.objects.filter(pk__in=pks), now)
+            decayed += len(pks)
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано рейтингов: {decayed}, обнулено: {cleared}'
+        ))
+
+    @staticmethod
+    @transaction.atomic
+    def decay(recipes, now):
+        # Рейтинг меняется только F()-выражениями, поэтому параллельные
+        # добавления в избранное не теряются. Добавления после прошлого
+        # пересчета затухают так, будто произошли в момент пересчета.
+        half_life = settings.TRENDING_HALF_LIFE.total_seconds()
+        for decayed_at in recipes.order_by().values_list(
+            'trending_decayed_at', flat=True
+        ).distinct():
+            factor = 1 if decayed_at is None else 0.5 ** (
+                (now - decayed_at).total_seconds() / half_life
+            )
+            recipes.filter(trending_decayed_at=decayed_at).update(
+                trending_score=F('trending_score') * factor,
+                trending_decayed_at=now
+            )
+        return recipes.filter(
+            trending_score__lt=settings.TRENDING_MIN_SCORE
+        ).update(trending_score=0, trending_decayed_at=None)
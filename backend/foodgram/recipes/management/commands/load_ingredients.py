@@ -4,7 +4,7 @@ import os
 from django.core.management import BaseCommand
 from foodgram.settings import BASE_DIR
 
-from recipes.models import Ingredient
+from recipes.models import DataVersion, Ingredient
 
 
 class Command(BaseCommand):
@@ -18,5 +18,6 @@ class Command(BaseCommand):
                 (Ingredient(**ingredient) for ingredient in data),
                 ignore_conflicts=True
             )
+        DataVersion.bump(DataVersion.INGREDIENTS)
 
         self.stdout.write(self.style.SUCCESS('Продукты успешно импортированы'))
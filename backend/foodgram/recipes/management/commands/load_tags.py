@@ -4,7 +4,7 @@ import os
 from django.core.management import BaseCommand
 from foodgram.settings import BASE_DIR
 
-from recipes.models import Tag
+from recipes.models import DataVersion, Tag
 
 
 class Command(BaseCommand):
@@ -18,5 +18,6 @@ class Command(BaseCommand):
                 (Tag(**tag) for tag in data),
                 ignore_conflicts=True
             )
+        DataVersion.bump(DataVersion.TAGS)
 
         self.stdout.write(self.style.SUCCESS('Теги успешно импортированы'))
@@ -0,0 +1,86 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Q, Sum
+
+from recipes.models import IngredientAmount, ShoppingListItem, User
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает или проверяет агрегированные списки покупок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Только сообщить о расхождениях, ничего не изменяя'
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    @staticmethod
+    def expected_items(user_ids):
+        return {
+            (row['recipe__shoppingcarts__user'], row['ingredient']):
+                row['total']
+            for row in IngredientAmount.objects.filter(
+                recipe__shoppingcarts__user__in=user_ids
+            ).values('recipe__shoppingcarts__user', 'ingredient').annotate(
+                total=Sum('amount')
+            ).order_by()
+        }
+
+    @staticmethod
+    def actual_items(user_ids):
+        return {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total in
+            ShoppingListItem.objects.filter(user_id__in=user_ids).values_list(
+                'user_id', 'ingredient_id', 'total_amount'
+            )
+        }
+
+    @transaction.atomic
+    def rebuild(self, user_ids, expected):
+        ShoppingListItem.objects.filter(user_id__in=user_ids).delete()
+        ShoppingListItem.objects.bulk_create(
+            ShoppingListItem(
+                user_id=user_id, ingredient_id=ingredient_id,
+                total_amount=total
+            )
+            for (user_id, ingredient_id), total in expected.items()
+            if user_id in user_ids
+        )
+
+    def handle(self, *args, verify, batch_size, **options):
+        user_ids = User.objects.filter(
+            Q(shoppingcarts__isnull=False) | Q(shopping_list__isnull=False)
+        ).distinct().order_by('id').values_list('id', flat=True)
+        checked = broken = 0
+        batch = []
+        for user_id in user_ids.iterator():
+            batch.append(user_id)
+            if len(batch) == batch_size:
+                broken += self.process(batch, verify)
+                checked += len(batch)
+                batch = []
+        if batch:
+            broken += self.process(batch, verify)
+            checked += len(batch)
+        action = 'найдено' if verify else 'исправлено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Проверено пользователей: {checked}, {action} '
+            f'списков с расхождениями: {broken}'
+        ))
+
+    def process(self, user_ids, verify):
+        expected = self.expected_items(user_ids)
+        actual = self.actual_items(user_ids)
+        broken = {
+            user_id for user_id, _ in
+            expected.keys() ^ actual.keys() | {
+                key for key in expected.keys() & actual.keys()
+                if expected[key] != actual[key]
+            }
+        }
+        if broken and not verify:
+            self.rebuild(broken, expected)
+        return len(broken)
@@ -0,0 +1,73 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from recipes.signals import COUNTERS
+
+
+class Command(BaseCommand):
+    help = 'Проверяет и исправляет денормализованные счетчики'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Только сообщить о расхождениях, ничего не изменяя'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    @staticmethod
+    def actual_counts(link_model, attname, pks):
+        return dict(
+            link_model.objects.filter(**{f'{attname}__in': pks}).values(
+                attname
+            ).annotate(count=Count('pk')).order_by().values_list(
+                attname, 'count'
+            )
+        )
+
+    def handle(self, *args, verify, batch_size, **options):
+        action = 'найдено' if verify else 'исправлено'
+        for link_model, counters in COUNTERS.items():
+            for model, attname, field in counters:
+                checked = drifted = 0
+                batch = []
+                for row in model.objects.order_by('pk').values_list(
+                    'pk', field
+                ).iterator(chunk_size=batch_size):
+                    batch.append(row)
+                    if len(batch) == batch_size:
+                        drifted += self.process(
+                            batch, model, field, link_model, attname, verify
+                        )
+                        checked += len(batch)
+                        batch = []
+                if batch:
+                    drifted += self.process(
+                        batch, model, field, link_model, attname, verify
+                    )
+                    checked += len(batch)
+                self.stdout.write(self.style.SUCCESS(
+                    f'{model._meta.label}.{field}: проверено {checked}, '
+                    f'{action} расхождений: {drifted}'
+                ))
+
+    def process(self, rows, model, field, link_model, attname, verify):
+        actual = self.actual_counts(
+            link_model, attname, [pk for pk, _ in rows]
+        )
+        drifted = [pk for pk, stored in rows if stored != actual.get(pk, 0)]
+        if drifted and not verify:
+            with transaction.atomic():
+                # Пересчитываем под блокировкой, чтобы не затереть
+                # изменения, сделанные F()-выражениями после первого чтения.
+                locked = list(model.objects.select_for_update().filter(
+                    pk__in=drifted
+                ).values_list('pk', flat=True))
+                actual = self.actual_counts(link_model, attname, locked)
+                model.objects.bulk_update(
+                    [model(pk=pk, **{field: actual.get(pk, 0)})
+                     for pk in locked],
+                    (field,)
+                )
+        return len(drifted)
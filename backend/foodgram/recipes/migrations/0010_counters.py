@@ -0,0 +1,60 @@
+# Generated by Django 4.2.6 on 2026-10-18 20:33
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    def count_of(model, field):
+        return Coalesce(Subquery(
+            apps.get_model('recipes', model).objects.filter(
+                **{field: OuterRef('pk')}
+            ).values(field).annotate(count=Count('pk')).values('count')
+        ), 0)
+
+    apps.get_model('recipes', 'Recipe').objects.update(
+        favorites_count=count_of('Favorite', 'recipe'),
+        shopping_cart_count=count_of('ShoppingCart', 'recipe'),
+    )
+    apps.get_model('recipes', 'User').objects.update(
+        recipes_count=count_of('Recipe', 'author'),
+        followers_count=count_of('Follow', 'author'),
+        following_count=count_of('Follow', 'user'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_image_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='shopping_cart_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='В списках покупок'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='followers_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Подписчиков'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='following_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Подписок'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='recipes_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Рецептов'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.6 on 2026-10-18 20:36
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+INGREDIENT_NAMES = (
+    "(SELECT {agg} FROM recipes_ingredientamount a "
+    "JOIN recipes_ingredient i ON i.id = a.ingredient_id "
+    "WHERE a.recipe_id = r.id)"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS recipe_search_vector_idx '
+            'ON recipes_recipe USING gin (search_vector)'
+        )
+        schema_editor.execute(
+            "UPDATE recipes_recipe r SET search_vector = "
+            "setweight(to_tsvector('russian', coalesce(r.name, '')), 'A') || "
+            "setweight(to_tsvector('russian', coalesce({}, '')), 'B') || "
+            "setweight(to_tsvector('russian', coalesce(r.text, '')), 'C')"
+            .format(INGREDIENT_NAMES.format(agg="string_agg(i.name, ' ')"))
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS recipes_recipe_fts USING '
+            'fts5(name, ingredients, text, '
+            'tokenize="unicode61 remove_diacritics 2")'
+        )
+        schema_editor.execute(
+            'INSERT INTO recipes_recipe_fts (rowid, name, ingredients, text) '
+            'SELECT r.id, r.name, {}, r.text FROM recipes_recipe r'
+            .format(INGREDIENT_NAMES.format(agg="group_concat(i.name, ' ')"))
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS recipe_search_vector_idx')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS recipes_recipe_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый вектор'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
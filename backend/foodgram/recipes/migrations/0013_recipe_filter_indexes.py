@@ -0,0 +1,24 @@
+# Generated by Django 4.2.6 on 2026-10-18 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_recipe_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', '-pub_date', '-id'], name='recipe_author_pub_date_idx'),
+        ),
+        # Таблица связи рецептов и тегов создается автоматически, поэтому
+        # составной индекс для EXISTS по тегу добавляется вручную.
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS recipe_tags_tag_recipe_idx '
+            'ON recipes_recipe_tags (tag_id, recipe_id)',
+            'DROP INDEX IF EXISTS recipe_tags_tag_recipe_idx',
+        ),
+    ]
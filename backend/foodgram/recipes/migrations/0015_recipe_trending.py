@@ -0,0 +1,32 @@
+# Generated by Django 4.2.6 on 2026-10-18 20:50
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_recipe_neighbours'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='trending_decayed_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Дата пересчета рейтинга трендов'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='trending_score',
+            field=models.FloatField(default=0, editable=False, verbose_name='Рейтинг трендов'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(models.OrderBy(django.db.models.expressions.CombinedExpression(models.F('favorites_count'), '+', models.F('shopping_cart_count')), descending=True), models.OrderBy(models.F('id'), descending=True), name='recipe_popularity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-trending_score', '-id'], name='recipe_trending_idx'),
+        ),
+    ]
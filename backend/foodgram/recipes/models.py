@@ -1,13 +1,31 @@
 from colorfield.fields import ColorField
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, RegexValidator
-from django.db import models
-from django.db.models import F, Q, Sum, UniqueConstraint
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Sum, UniqueConstraint, Value, When
 
+from recipes.storage import recipe_image_storage
 from recipes.validators import validate_username
 
 
-class User(AbstractUser):
+class CountersMixin:
+    """Счетчики меняются только F()-выражениями, поэтому save() не
+    перезаписывает их значениями, загруженными вместе с объектом."""
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            skipped = {*self.counter_fields, *self.get_deferred_fields()}
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped
+            ]
+        super().save(*args, **kwargs)
+
+
+class User(CountersMixin, AbstractUser):
     email = models.EmailField(
         unique=True,
         verbose_name='Email',
@@ -22,6 +40,22 @@ class User(AbstractUser):
         unique=True,
         validators=[validate_username]
     )
+    recipes_count = models.IntegerField(
+        verbose_name='Рецептов',
+        default=0,
+        editable=False
+    )
+    followers_count = models.IntegerField(
+        verbose_name='Подписчиков',
+        default=0,
+        editable=False
+    )
+    following_count = models.IntegerField(
+        verbose_name='Подписок',
+        default=0,
+        editable=False
+    )
+    counter_fields = ('recipes_count', 'followers_count', 'following_count')
 
     class Meta:
         verbose_name = "Пользователь"
@@ -31,6 +65,14 @@ class User(AbstractUser):
     def __str__(self):
         return self.username
 
+    @classmethod
+    def lock(cls, pk):
+        """Блокирует строку пользователя до конца транзакции, чтобы
+        изменения его подписок, избранного и списка покупок шли по
+        очереди и сигналы отправлялись только о действительно
+        добавленных и удаленных строках."""
+        cls.objects.select_for_update().filter(pk=pk).exists()
+
 
 class Follow(models.Model):
     user = models.ForeignKey(
@@ -123,7 +165,11 @@ class Ingredient(models.Model):
         return f'{self.name}, {self.measurement_unit}'
 
 
-class Recipe(models.Model):
+# Популярность рецепта за все время, по ней же построен индекс.
+POPULARITY = F('favorites_count') + F('shopping_cart_count')
+
+
+class Recipe(CountersMixin, models.Model):
     tags = models.ManyToManyField(
         Tag,
         verbose_name='Теги',
@@ -147,7 +193,8 @@ class Recipe(models.Model):
     )
     image = models.ImageField(
         verbose_name='Изображение',
-        upload_to='recipes/image/'
+        upload_to='recipes/image/',
+        storage=recipe_image_storage
     )
     text = models.TextField(verbose_name='Описание')
     cooking_time = models.PositiveSmallIntegerField(
@@ -161,22 +208,126 @@ class Recipe(models.Model):
         verbose_name='Дата публикации',
         auto_now_add=True
     )
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+        auto_now=True,
+        db_index=True
+    )
+    version = models.PositiveIntegerField(
+        verbose_name='Версия',
+        default=0,
+        editable=False
+    )
+    image_variants = models.JSONField(
+        verbose_name='Уменьшенные копии изображения',
+        default=dict,
+        blank=True,
+        editable=False
+    )
+    favorites_count = models.IntegerField(
+        verbose_name='В избранном',
+        default=0,
+        editable=False
+    )
+    shopping_cart_count = models.IntegerField(
+        verbose_name='В списках покупок',
+        default=0,
+        editable=False
+    )
+    search_vector = SearchVectorField(
+        verbose_name='Поисковый вектор',
+        null=True,
+        editable=False
+    )
+    trending_score = models.FloatField(
+        verbose_name='Рейтинг трендов',
+        default=0,
+        editable=False
+    )
+    trending_decayed_at = models.DateTimeField(
+        verbose_name='Дата пересчета рейтинга трендов',
+        null=True,
+        editable=False
+    )
+    neighbours_updated_at = models.DateTimeField(
+        verbose_name='Дата расчета похожих рецептов',
+        null=True,
+        editable=False
+    )
+    counter_fields = (
+        'version', 'favorites_count', 'shopping_cart_count',
+        'trending_score', 'trending_decayed_at',
+    )
+
+    # Интервалы времени приготовления для фильтров, границы включительно:
+    # (значение, от, до, название).
+    COOKING_TIME_BUCKETS = (
+        ('fast', 1, 15, 'Быстрые (до 15 мин.)'),
+        ('medium', 16, 45, 'Средние (от 16 до 45 мин.)'),
+        ('long', 46, None, 'Долгие (больше 45 мин.)'),
+    )
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
-        ordering = ('-pub_date',)
+        ordering = ('-pub_date', '-id')
+        indexes = [
+            models.Index(
+                fields=('-pub_date', '-id'),
+                name='recipe_pub_date_id_idx'
+            ),
+            models.Index(
+                fields=('author', '-pub_date', '-id'),
+                name='recipe_author_pub_date_idx'
+            ),
+            models.Index(
+                POPULARITY.desc(), F('id').desc(),
+                name='recipe_popularity_idx'
+            ),
+            models.Index(
+                fields=('-trending_score', '-id'),
+                name='recipe_trending_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
     @staticmethod
     def create_shopping_cart_list(user):
-        return IngredientAmount.objects.filter(
-            recipe__shoppingcarts__user=user
-        ).order_by('ingredient__name').values(
-            'ingredient__name', 'ingredient__measurement_unit', 'recipe__name'
-        ).annotate(amount=Sum('amount'))
+        return ShoppingListItem.objects.filter(user=user).values(
+            'ingredient__name',
+            'ingredient__measurement_unit',
+            amount=F('total_amount'),
+        ).order_by('ingredient__name', 'ingredient__measurement_unit')
+
+    @classmethod
+    def cooking_time_q(cls, bucket):
+        for name, low, high, _ in cls.COOKING_TIME_BUCKETS:
+            if name == bucket:
+                return Q(cooking_time__gte=low) & (
+                    Q(cooking_time__lte=high) if high else Q()
+                )
+        raise ValueError(f'Неизвестный интервал времени: {bucket}')
+
+    def get_image_variants(self):
+        """Имена файлов уменьшенных копий текущего изображения, пока они
+        не готовы - имя оригинала."""
+        variants = (
+            self.image_variants
+            if self.image_variants.get('source') == self.image.name else {}
+        )
+        return {
+            variant: variants.get(variant, self.image.name)
+            for variant in settings.IMAGE_VARIANTS
+        }
+
+    def ingredient_amounts(self):
+        return dict(
+            self.ingredientinrecipes.values('ingredient_id').annotate(
+                total=Sum('amount')
+            ).values_list('ingredient_id', 'total')
+        )
 
 
 class IngredientAmount(models.Model):
@@ -243,3 +394,201 @@ class ShoppingCart(UserRecipe):
     class Meta(UserRecipe.Meta):
         verbose_name = 'Корзина'
         verbose_name_plural = 'Корзины'
+
+
+class RecipeNeighbour(models.Model):
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='neighbours',
+        verbose_name='Рецепт'
+    )
+    neighbour = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similar_to',
+        verbose_name='Похожий рецепт'
+    )
+    similarity = models.FloatField(verbose_name='Сходство')
+
+    class Meta:
+        verbose_name = 'Похожий рецепт'
+        verbose_name_plural = 'Похожие рецепты'
+        ordering = ('recipe', '-similarity', '-neighbour_id')
+        constraints = [
+            UniqueConstraint(
+                fields=('recipe', 'neighbour'),
+                name='unique_recipe_neighbour'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=('recipe', '-similarity'),
+                name='neighbour_recipe_similarity'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.recipe} ~ {self.neighbour}: {self.similarity:.2f}'
+
+
+class FeedEntry(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Подписчик'
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Рецепт'
+    )
+    pub_date = models.DateTimeField(verbose_name='Дата публикации')
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Лента подписок'
+        ordering = ('-pub_date',)
+        constraints = [
+            UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_feed_entry'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=('user', '-pub_date'),
+                name='feed_user_pub_date_idx'
+            ),
+            models.Index(
+                fields=('user', 'author'),
+                name='feed_user_author_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.user} : {self.recipe}'
+
+
+class DataVersion(models.Model):
+    TAGS = 'tags'
+    INGREDIENTS = 'ingredients'
+
+    name = models.CharField(
+        max_length=50,
+        unique=True,
+        verbose_name='Набор данных'
+    )
+    version = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Версия'
+    )
+
+    class Meta:
+        verbose_name = 'Версия справочника'
+        verbose_name_plural = 'Версии справочников'
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
+
+    @classmethod
+    def get(cls, name):
+        return cls.objects.filter(name=name).values_list(
+            'version', flat=True
+        ).first() or 0
+
+    @classmethod
+    def bump(cls, name):
+        cls.objects.bulk_create([cls(name=name)], ignore_conflicts=True)
+        cls.objects.filter(name=name).update(version=F('version') + 1)
+
+
+class ShoppingListItem(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Пользователь'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Продукт'
+    )
+    total_amount = models.IntegerField(verbose_name='Общее количество')
+
+    class Meta:
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Списки покупок'
+        constraints = [
+            UniqueConstraint(
+                fields=('user', 'ingredient'),
+                name='unique_shopping_list_item'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} : {self.ingredient} - {self.total_amount}'
+
+    @classmethod
+    @transaction.atomic
+    def change(cls, user_ids, deltas, batch_size=1000):
+        """Прибавляет deltas {ingredient_id: количество} к спискам покупок
+        пользователей user_ids (список или queryset значений user_id)."""
+        deltas = {
+            ingredient_id: delta
+            for ingredient_id, delta in deltas.items() if delta
+        }
+        if not deltas:
+            return
+        added = [
+            ingredient_id for ingredient_id, delta in deltas.items()
+            if delta > 0
+        ]
+        batch = []
+        for user_id in (
+            user_ids.iterator() if hasattr(user_ids, 'iterator')
+            else user_ids
+        ):
+            batch.extend(
+                cls(user_id=user_id, ingredient_id=ingredient_id,
+                    total_amount=0)
+                for ingredient_id in added
+            )
+            if len(batch) >= batch_size:
+                cls.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        cls.objects.bulk_create(batch, ignore_conflicts=True)
+        items = cls.objects.filter(
+            user_id__in=user_ids, ingredient_id__in=deltas
+        )
+        items.update(total_amount=F('total_amount') + Case(
+            *(When(ingredient_id=ingredient_id, then=Value(delta))
+              for ingredient_id, delta in deltas.items()),
+            default=Value(0)
+        ))
+        items.filter(total_amount__lte=0).delete()
+
+    @classmethod
+    def recipe_changed(cls, recipe, old_amounts):
+        new_amounts = recipe.ingredient_amounts()
+        cls.change(
+            ShoppingCart.objects.filter(recipe=recipe).values_list(
+                'user_id', flat=True
+            ),
+            {
+                ingredient_id: (
+                    new_amounts.get(ingredient_id, 0)
+                    - old_amounts.get(ingredient_id, 0)
+                ) for ingredient_id in {*old_amounts, *new_amounts}
+            }
+        )
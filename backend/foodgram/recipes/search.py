@@ -0,0 +1,98 @@
+import re
+
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connection
+from django.db.models import F, OuterRef, Subquery, TextField, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+
+from recipes.models import IngredientAmount, Recipe
+
+SEARCH_CONFIG = 'russian'
+FTS_TABLE = 'recipes_recipe_fts'
+# Ограничение SQLite на число параметров запроса.
+BATCH_SIZE = 500
+
+
+def ingredient_names():
+    return Coalesce(Subquery(
+        IngredientAmount.objects.filter(recipe=OuterRef('pk')).values(
+            'recipe_id'
+        ).annotate(
+            names=StringAgg('ingredient__name', ' ')
+        ).order_by().values('names')
+    ), Value(''), output_field=TextField())
+
+
+def index_sqlite(recipe_ids):
+    placeholders = ', '.join(['%s'] * len(recipe_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})',
+            recipe_ids
+        )
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, ingredients, text) '
+            f'SELECT r.id, r.name, ('
+            f'  SELECT group_concat(i.name, \' \') '
+            f'  FROM recipes_ingredientamount a '
+            f'  JOIN recipes_ingredient i ON i.id = a.ingredient_id '
+            f'  WHERE a.recipe_id = r.id'
+            f'), r.text FROM recipes_recipe r WHERE r.id IN ({placeholders})',
+            recipe_ids
+        )
+
+
+def index_recipes(recipe_ids):
+    """Пересчитывает поисковый индекс рецептов: tsvector с весами
+    название > продукты > описание в PostgreSQL, таблицу FTS5 в SQLite."""
+    recipe_ids = list(recipe_ids)
+    for start in range(0, len(recipe_ids), BATCH_SIZE):
+        batch = recipe_ids[start:start + BATCH_SIZE]
+        if connection.vendor == 'postgresql':
+            Recipe.objects.filter(pk__in=batch).update(search_vector=(
+                SearchVector('name', weight='A', config=SEARCH_CONFIG)
+                + SearchVector(
+                    ingredient_names(), weight='B', config=SEARCH_CONFIG
+                )
+                + SearchVector('text', weight='C', config=SEARCH_CONFIG)
+            ))
+        elif connection.vendor == 'sqlite':
+            index_sqlite(batch)
+
+
+def unindex_recipe(recipe_id):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [recipe_id]
+            )
+
+
+def search_recipes(recipes, text):
+    """Оставляет рецепты, подходящие под запрос, и сортирует их
+    по релевантности."""
+    if connection.vendor == 'postgresql':
+        query = SearchQuery(
+            text, config=SEARCH_CONFIG, search_type='websearch'
+        )
+        return recipes.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query)
+        ).order_by('-search_rank', '-pub_date', '-id')
+    # В FTS5 нет русского стемминга: слова ищутся по префиксу.
+    words = re.findall(r'\w+', text)
+    if not words:
+        return recipes.none()
+    query = ' '.join(f'"{word}"*' for word in words)
+    # Совпадения отбираются подзапросом, а не заранее выбранным списком
+    # id, чтобы остальные фильтры применялись ко всем найденным рецептам.
+    return recipes.filter(pk__in=RawSQL(
+        f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [query]
+    )).annotate(search_rank=RawSQL(
+        f'SELECT bm25({FTS_TABLE}, 10.0, 5.0, 1.0) FROM {FTS_TABLE} '
+        f'WHERE {FTS_TABLE} MATCH %s '
+        f'AND rowid = {Recipe._meta.db_table}.id',
+        [query]
+    )).order_by('search_rank', '-pub_date', '-id')
@@ -0,0 +1,320 @@
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, QuerySet
+from django.db.models.functions import Greatest
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import Signal, receiver
+
+from recipes import images, search, timeline
+from recipes.models import (
+    DataVersion, Favorite, Follow, Ingredient, IngredientAmount, Recipe,
+    ShoppingCart, ShoppingListItem, Tag, User
+)
+
+# bulk_create не вызывает post_save, а при удалении queryset-ом построчные
+# обработчики пропускаются: массовые операции сообщают о себе этими
+# сигналами с аргументом instances, чтобы обработать все строки разом.
+bulk_created = Signal()
+bulk_deleted = Signal()
+
+
+def bump_recipe_versions(**lookups):
+    Recipe.objects.filter(**lookups).update(version=F('version') + 1)
+
+
+@receiver(post_save, sender=Recipe)
+def bump_recipe_version(sender, instance, created, **kwargs):
+    if not created:
+        bump_recipe_versions(pk=instance.pk)
+        instance.refresh_from_db(fields=('version',))
+
+
+@receiver((post_save, post_delete), sender=IngredientAmount)
+def ingredient_amount_changed(sender, instance, **kwargs):
+    bump_recipe_versions(pk=instance.recipe_id)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        bump_recipe_versions(pk=instance.pk)
+    elif action == 'pre_clear':
+        bump_recipe_versions(tags=instance)
+    else:
+        bump_recipe_versions(pk__in=pk_set)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def tag_changed(sender, instance, **kwargs):
+    bump_recipe_versions(tags=instance)
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_changed(sender, instance, created, **kwargs):
+    if not created:
+        bump_recipe_versions(ingredients=instance)
+        transaction.on_commit(lambda: search.index_recipes(
+            Recipe.objects.filter(ingredients=instance).values_list(
+                'pk', flat=True
+            ).distinct()
+        ))
+
+
+@receiver(post_save, sender=User)
+def author_changed(sender, instance, created, update_fields, **kwargs):
+    if created or update_fields and set(update_fields) <= {'last_login'}:
+        return
+    bump_recipe_versions(author=instance)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_published(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: timeline.fan_out(instance))
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_image_saved(sender, instance, **kwargs):
+    name = instance.image.name
+    if name and instance.image_variants.get('source') != name:
+        transaction.on_commit(
+            lambda: images.process_image(instance.pk, name)
+        )
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved_for_search(sender, instance, **kwargs):
+    # Продукты сохраняются после рецепта, поэтому индекс обновляется
+    # после фиксации транзакции.
+    transaction.on_commit(lambda: search.index_recipes([instance.pk]))
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted_from_search(sender, instance, **kwargs):
+    search.unindex_recipe(instance.pk)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if created:
+        timeline.backfill(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, origin, **kwargs):
+    if isinstance(origin, Follow):
+        timeline.unfollow(instance.user_id, instance.author_id)
+
+
+@receiver(bulk_created, sender=Follow)
+def follows_created(sender, instances, **kwargs):
+    for follow in instances:
+        timeline.backfill(follow.user_id, follow.author_id)
+
+
+@receiver(bulk_deleted, sender=Follow)
+def follows_deleted(sender, instances, **kwargs):
+    for follow in instances:
+        timeline.unfollow(follow.user_id, follow.author_id)
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def tags_changed(sender, **kwargs):
+    DataVersion.bump(DataVersion.TAGS)
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def ingredients_changed(sender, **kwargs):
+    DataVersion.bump(DataVersion.INGREDIENTS)
+
+
+def negated(amounts):
+    return {
+        ingredient_id: -amount for ingredient_id, amount in amounts.items()
+    }
+
+
+@receiver(post_save, sender=ShoppingCart)
+def added_to_shopping_cart(sender, instance, created, **kwargs):
+    if created:
+        ShoppingListItem.change(
+            [instance.user_id], instance.recipe.ingredient_amounts()
+        )
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def removed_from_shopping_cart(sender, instance, origin, **kwargs):
+    # При удалении рецепта или пользователя списки пересчитываются целиком
+    # в обработчике рецепта или удаляются каскадом, при удалении
+    # queryset-ом - в обработчике bulk_deleted.
+    if not isinstance(origin, ShoppingCart):
+        return
+    ShoppingListItem.change(
+        [instance.user_id], negated(instance.recipe.ingredient_amounts())
+    )
+
+
+def shopping_list_deltas(carts, sign):
+    users = defaultdict(list)
+    for cart in carts:
+        users[cart.recipe_id].append(cart.user_id)
+    deltas = defaultdict(Counter)
+    for recipe_id, ingredient_id, amount in (
+        IngredientAmount.objects.filter(recipe_id__in=users).values_list(
+            'recipe_id', 'ingredient_id', 'amount'
+        )
+    ):
+        for user_id in users[recipe_id]:
+            deltas[user_id][ingredient_id] += sign * amount
+    return deltas
+
+
+@receiver(bulk_created, sender=ShoppingCart)
+def added_to_shopping_cart_in_bulk(sender, instances, **kwargs):
+    for user_id, deltas in shopping_list_deltas(instances, 1).items():
+        ShoppingListItem.change([user_id], deltas)
+
+
+@receiver(bulk_deleted, sender=ShoppingCart)
+def removed_from_shopping_cart_in_bulk(sender, instances, **kwargs):
+    for user_id, deltas in shopping_list_deltas(instances, -1).items():
+        ShoppingListItem.change([user_id], deltas)
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    ShoppingListItem.change(
+        ShoppingCart.objects.filter(recipe=instance).values_list(
+            'user_id', flat=True
+        ),
+        negated(instance.ingredient_amounts())
+    )
+
+
+# Модель связи: ((модель со счетчиком, поле ссылки, поле счетчика), ...).
+COUNTERS = {
+    Favorite: ((Recipe, 'recipe_id', 'favorites_count'),),
+    ShoppingCart: ((Recipe, 'recipe_id', 'shopping_cart_count'),),
+    Follow: (
+        (User, 'author_id', 'followers_count'),
+        (User, 'user_id', 'following_count'),
+    ),
+    Recipe: ((User, 'author_id', 'recipes_count'),),
+}
+
+
+def change_counters(model, field, deltas, floor=None):
+    """Одно UPDATE с F() на каждое различное значение изменения;
+    floor - наименьшее допустимое значение поля."""
+    pks_by_delta = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            pks_by_delta[delta].append(pk)
+    for delta, pks in pks_by_delta.items():
+        value = F(field) + delta
+        if floor is not None:
+            value = Greatest(value, floor)
+        model.objects.filter(pk__in=pks).update(**{field: value})
+
+
+def update_counters(sender, instances, sign, skipped_model=None):
+    for model, attname, field in COUNTERS[sender]:
+        if model is not skipped_model:
+            change_counters(model, field, {
+                pk: sign * count for pk, count in
+                Counter(getattr(item, attname) for item in instances).items()
+            })
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_save, sender=Follow)
+@receiver(post_save, sender=Recipe)
+def counted_created(sender, instance, created, **kwargs):
+    if created:
+        update_counters(sender, [instance], 1)
+
+
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+@receiver(post_delete, sender=Follow)
+@receiver(post_delete, sender=Recipe)
+def counted_deleted(sender, instance, origin, **kwargs):
+    origin_model = getattr(origin, 'model', type(origin))
+    if (
+        isinstance(origin, QuerySet) and origin_model is sender
+        and sender is not Recipe
+    ):
+        # Удаление queryset-ом обрабатывается по сигналу bulk_deleted.
+        return
+    # Счетчики удаляемого рецепта обновлять незачем.
+    update_counters(
+        sender, [instance], -1, Recipe if origin_model is Recipe else None
+    )
+
+
+@receiver(bulk_created, sender=Favorite)
+@receiver(bulk_created, sender=ShoppingCart)
+@receiver(bulk_created, sender=Follow)
+def counted_created_in_bulk(sender, instances, **kwargs):
+    update_counters(sender, instances, 1)
+
+
+@receiver(bulk_deleted, sender=Favorite)
+@receiver(bulk_deleted, sender=ShoppingCart)
+@receiver(bulk_deleted, sender=Follow)
+def counted_deleted_in_bulk(sender, instances, **kwargs):
+    update_counters(sender, instances, -1)
+
+
+def bump_trending(sender, instances, sign=1):
+    """Добавления в избранное и в список покупок повышают рейтинг трендов,
+    удаления - понижают, но не ниже нуля: иначе повторное добавление и
+    удаление поднимали бы рецепт без конца. Затухание с течением времени
+    применяет команда decay_trending."""
+    weight = sign * (
+        settings.TRENDING_FAVORITE_WEIGHT if sender is Favorite
+        else settings.TRENDING_SHOPPING_CART_WEIGHT
+    )
+    change_counters(Recipe, 'trending_score', {
+        recipe_id: weight * count for recipe_id, count in
+        Counter(item.recipe_id for item in instances).items()
+    }, floor=0.0)
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+def trending_created(sender, instance, created, **kwargs):
+    if created:
+        bump_trending(sender, [instance])
+
+
+@receiver(bulk_created, sender=Favorite)
+@receiver(bulk_created, sender=ShoppingCart)
+def trending_created_in_bulk(sender, instances, **kwargs):
+    bump_trending(sender, instances)
+
+
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+def trending_deleted(sender, instance, origin, **kwargs):
+    origin_model = getattr(origin, 'model', type(origin))
+    if origin_model is Recipe or (
+        isinstance(origin, QuerySet) and origin_model is sender
+    ):
+        # Рейтинг удаляемого рецепта не нужен, удаление queryset-ом
+        # обрабатывается по сигналу bulk_deleted.
+        return
+    bump_trending(sender, [instance], -1)
+
+
+@receiver(bulk_deleted, sender=Favorite)
+@receiver(bulk_deleted, sender=ShoppingCart)
+def trending_deleted_in_bulk(sender, instances, **kwargs):
+    bump_trending(sender, instances, -1)
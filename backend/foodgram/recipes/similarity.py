@@ -0,0 +1,203 @@
+from array import array
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+from scipy import sparse
+
+from recipes.models import IngredientAmount, Recipe, RecipeNeighbour
+
+
+class IngredientMatrix:
+    """Разреженная матрица рецепт x продукт из нулей и единиц.
+
+    Сходство рецептов - коэффициент Жаккара их наборов продуктов без
+    самых распространенных: число общих продуктов берется из
+    произведения строк матрицы на транспонированную матрицу.
+    """
+
+    def __init__(self):
+        recipe_ids, ingredient_ids = array('I'), array('I')
+        for recipe_id, ingredient_id in (
+            IngredientAmount.objects.order_by().distinct().values_list(
+                'recipe_id', 'ingredient_id'
+            ).iterator(chunk_size=10000)
+        ):
+            recipe_ids.append(recipe_id)
+            ingredient_ids.append(ingredient_id)
+        columns = np.frombuffer(ingredient_ids, dtype=np.uint32)
+        self.ids, rows = np.unique(
+            np.frombuffer(recipe_ids, dtype=np.uint32), return_inverse=True
+        )
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, columns)),
+            shape=(len(self.ids), int(columns.max(initial=0)) + 1)
+        )
+        # Продукты почти из каждого рецепта (соль, вода) не говорят о
+        # сходстве, а число сравниваемых пар из-за них растет квадратично.
+        frequencies = np.diff(matrix.tocsc().indptr)
+        self.matrix = matrix[:, np.flatnonzero(
+            frequencies <= settings.RECIPE_NEIGHBOURS_MAX_FREQUENCY
+        )]
+        self.transposed = self.matrix.T.tocsr()
+        self.sizes = np.diff(self.matrix.indptr).astype(np.float32)
+        # Сколько пар даст строка при умножении: сумма частот ее продуктов.
+        self.costs = self.matrix @ np.diff(self.transposed.indptr)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, recipe_ids):
+        recipe_ids = np.fromiter(recipe_ids, dtype=np.int64)
+        found = np.searchsorted(self.ids, recipe_ids)
+        found = found[found < len(self.ids)]
+        return found[np.isin(self.ids[found], recipe_ids)]
+
+    def chunks(self, positions, batch_size, max_pairs):
+        """Делит строки на пачки не больше batch_size строк и примерно
+        max_pairs пар, чтобы память на произведение была ограничена."""
+        chunk, pairs = [], 0
+        for position in positions:
+            cost = self.costs[position]
+            if chunk and (
+                len(chunk) == batch_size or pairs + cost > max_pairs
+            ):
+                yield np.array(chunk)
+                chunk, pairs = [], 0
+            chunk.append(position)
+            pairs += cost
+        if chunk:
+            yield np.array(chunk)
+
+    def similarities(self, positions, min_similarity):
+        """Пары (строка, соседняя строка, сходство) со сходством не ниже
+        min_similarity, по строкам и убыванию сходства."""
+        products = self.matrix[positions] @ self.transposed
+        counts = np.diff(products.indptr)
+        shared = products.data
+        # Сходство не больше shared / |a|: по нему дешево отсекаем
+        # большинство пар до выборки размеров соседей.
+        keep = shared >= min_similarity * np.repeat(
+            self.sizes[positions], counts
+        )
+        rows = np.repeat(positions, counts)[keep]
+        columns = products.indices[keep]
+        shared = shared[keep]
+        similarity = shared / (
+            self.sizes[rows] + self.sizes[columns] - shared
+        )
+        keep = (columns != rows) & (similarity >= min_similarity)
+        rows, columns, similarity = (
+            rows[keep], columns[keep], similarity[keep]
+        )
+        order = np.lexsort((-columns, -similarity, rows))
+        return rows[order], columns[order], similarity[order]
+
+
+def top(rows, columns, similarity, limit):
+    """Первые limit пар каждой строки из результата similarities()."""
+    keep = np.arange(len(rows)) - np.searchsorted(rows, rows) < limit
+    return rows[keep], columns[keep], similarity[keep]
+
+
+def save_neighbours(matrix, positions, rows, columns, similarity, built_at):
+    recipe_ids = matrix.ids[positions].tolist()
+    with transaction.atomic():
+        # Рецепты, удаленные во время расчета, пропускаем.
+        existing = set(Recipe.objects.filter(
+            pk__in={*recipe_ids, *matrix.ids[columns].tolist()}
+        ).values_list('pk', flat=True))
+        RecipeNeighbour.objects.filter(recipe_id__in=recipe_ids).delete()
+        RecipeNeighbour.objects.bulk_create(
+            [
+                RecipeNeighbour(
+                    recipe_id=recipe_id,
+                    neighbour_id=neighbour_id,
+                    similarity=value
+                )
+                for recipe_id, neighbour_id, value in zip(
+                    matrix.ids[rows].tolist(),
+                    matrix.ids[columns].tolist(),
+                    similarity.tolist()
+                )
+                if recipe_id in existing and neighbour_id in existing
+            ],
+            batch_size=1000
+        )
+        Recipe.objects.filter(pk__in=recipe_ids).update(
+            neighbours_updated_at=built_at
+        )
+
+
+def displaced(matrix, best, stale, batch_size):
+    """Строки, в чьи списки похожих рецептов попадает или из чьих
+    списков выпадает один из пересчитанных рецептов stale."""
+    min_similarity = settings.RECIPE_NEIGHBOURS_MIN_SIMILARITY
+    stale_ids = matrix.ids[stale].tolist()
+    affected = set()
+    for start in range(0, len(stale_ids), batch_size):
+        affected.update(RecipeNeighbour.objects.filter(
+            neighbour_id__in=stale_ids[start:start + batch_size]
+        ).values_list('recipe_id', flat=True))
+    best[stale] = 0
+    candidates = np.flatnonzero(best >= min_similarity)
+    for start in range(0, len(candidates), batch_size):
+        batch = candidates[start:start + batch_size]
+        current = {
+            recipe_id: (count, lowest)
+            for recipe_id, count, lowest in RecipeNeighbour.objects.filter(
+                recipe_id__in=matrix.ids[batch].tolist()
+            ).values('recipe_id').annotate(
+                count=Count('pk'), lowest=Min('similarity')
+            ).order_by().values_list('recipe_id', 'count', 'lowest')
+        }
+        for recipe_id, value in zip(
+            matrix.ids[batch].tolist(), best[batch].tolist()
+        ):
+            count, lowest = current.get(recipe_id, (0, 0))
+            if count < settings.RECIPE_NEIGHBOURS or value > lowest:
+                affected.add(recipe_id)
+    return np.setdiff1d(matrix.positions(affected), stale)
+
+
+def rebuild_neighbours(full, batch_size, max_pairs):
+    """Пересчитывает похожие рецепты: все или только измененные
+    с прошлого расчета вместе с рецептами, чьи списки это затрагивает.
+    Возвращает число пересчитанных рецептов."""
+    built_at = timezone.now()
+    matrix = IngredientMatrix()
+    if not len(matrix):
+        return 0
+    limit = settings.RECIPE_NEIGHBOURS
+    min_similarity = settings.RECIPE_NEIGHBOURS_MIN_SIMILARITY
+    if full:
+        stale = np.arange(len(matrix))
+    else:
+        stale = matrix.positions(Recipe.objects.filter(
+            Q(neighbours_updated_at__isnull=True)
+            | Q(neighbours_updated_at__lt=F('updated_at'))
+        ).values_list('pk', flat=True).iterator())
+    # Лучшее сходство каждого рецепта с пересчитанными.
+    best = np.zeros(len(matrix), dtype=np.float32)
+    for chunk in matrix.chunks(stale, batch_size, max_pairs):
+        rows, columns, similarity = matrix.similarities(
+            chunk, min_similarity
+        )
+        if not full:
+            np.maximum.at(best, columns, similarity)
+        save_neighbours(
+            matrix, chunk, *top(rows, columns, similarity, limit), built_at
+        )
+    rebuilt = len(stale)
+    if not full and rebuilt:
+        affected = displaced(matrix, best, stale, batch_size)
+        for chunk in matrix.chunks(affected, batch_size, max_pairs):
+            save_neighbours(
+                matrix, chunk,
+                *top(*matrix.similarities(chunk, min_similarity), limit),
+                built_at
+            )
+        rebuilt += len(affected)
+    return rebuilt
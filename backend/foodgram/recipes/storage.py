@@ -0,0 +1,37 @@
+import os
+from hashlib import sha256
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Сохраняет файл под именем sha256 его содержимого в подкаталогах
+    по первым символам хэша. Одинаковые файлы хранятся один раз, а URL
+    файла никогда не указывает на другое содержимое. Неиспользуемые файлы
+    удаляет команда collect_media_garbage."""
+
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content_hash = digest.hexdigest()
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        name = os.path.join(
+            directory, content_hash[:2], content_hash[2:4],
+            content_hash + extension
+        )
+        if self.exists(name):
+            # Обновляем время изменения, чтобы сборщик мусора не удалил
+            # файл, на который сейчас снова появится ссылка.
+            os.utime(self.path(name))
+            return name
+        return super().save(name, content, max_length)
+
+
+recipe_image_storage = ContentAddressedStorage()
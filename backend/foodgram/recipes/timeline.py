@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.db.models import F, OuterRef, Q, Subquery, Window
+from django.db.models.functions import RowNumber
+
+from recipes.models import FeedEntry, Follow, Recipe, User
+
+
+def is_pulled(author_id):
+    return User.objects.filter(
+        pk=author_id, followers_count__gt=settings.FEED_FANOUT_LIMIT
+    ).exists()
+
+
+def pulled_authors(user):
+    return User.objects.filter(
+        following__user=user,
+        followers_count__gt=settings.FEED_FANOUT_LIMIT
+    )
+
+
+def entries(user_id, recipes):
+    return [
+        FeedEntry(
+            user_id=user_id,
+            author_id=recipe.author_id,
+            recipe_id=recipe.id,
+            pub_date=recipe.pub_date,
+        ) for recipe in recipes
+    ]
+
+
+def fan_out(recipe):
+    if is_pulled(recipe.author_id):
+        return
+    followers = Follow.objects.filter(
+        author_id=recipe.author_id
+    ).values_list('user_id', flat=True)
+    batch = []
+    for user_id in followers.iterator(chunk_size=settings.FEED_BATCH_SIZE):
+        batch.extend(entries(user_id, [recipe]))
+        if len(batch) >= settings.FEED_BATCH_SIZE:
+            FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def backfill(user_id, author_id):
+    if is_pulled(author_id):
+        return
+    FeedEntry.objects.bulk_create(
+        entries(user_id, Recipe.objects.filter(
+            author_id=author_id
+        )[:settings.FEED_BACKFILL]),
+        ignore_conflicts=True
+    )
+
+
+def unfollow(user_id, author_id):
+    FeedEntry.objects.filter(user_id=user_id, author_id=author_id).delete()
+
+
+def pull(user):
+    """Дописывает в ленту рецепты авторов с большим числом подписчиков,
+    опубликованные после последней записи ленты от каждого из них;
+    в первый раз - последние FEED_BACKFILL рецептов автора. Более
+    старые рецепты не подтягиваются, поэтому повторные запросы ленты
+    ничего не пишут, пока автор не опубликует новый рецепт. Рецепты всех
+    авторов выбираются одним запросом."""
+    recipes = Recipe.objects.filter(
+        author__in=pulled_authors(user)
+    ).annotate(newest=Subquery(
+        FeedEntry.objects.filter(
+            user=user, author=OuterRef('author_id')
+        ).order_by('-pub_date').values('pub_date')[:1]
+    )).filter(
+        Q(newest__isnull=True) | Q(pub_date__gt=F('newest'))
+    ).annotate(number=Window(
+        RowNumber(),
+        partition_by=F('author_id'),
+        order_by=(F('pub_date').desc(), F('id').desc())
+    )).filter(number__lte=settings.FEED_BACKFILL).only(
+        'id', 'author_id', 'pub_date'
+    )
+    FeedEntry.objects.bulk_create(
+        entries(user.id, recipes), ignore_conflicts=True
+    )